@@ -0,0 +1,110 @@
+from lstore.db import Database
+from lstore.query import Query
+
+from random import choice, randint, sample, seed
+import os
+import shutil
+
+# Crash recovery test: a child process inserts, updates, merges and deletes, then dies with os._exit without closing
+# the database. Every committed change has to be there when the parent reopens it, for every storage backend
+
+number_of_records = 1000
+number_of_updates = 2000
+number_of_deletes = 100
+number_of_aggregates = 100
+
+for storage in ('file', 'segment', 'mmap'):
+    path = './CrashTest_' + storage
+    shutil.rmtree(path, ignore_errors=True)
+    seed(3562901)
+
+    # part 0: a database that is opened and closed without a single write, twice
+    for _ in range(2):
+        db = Database()
+        db.open(path, storage=storage)
+        db.close()
+    shutil.rmtree(path, ignore_errors=True)
+
+    # dictionary for records to test the database: test directory
+    records = {}
+
+    # part 1: insert and close cleanly
+    db = Database()
+    db.open(path, storage=storage)
+    grades_table = db.create_table('Grades', 5, 0)
+    query = Query(grades_table)
+    for i in range(0, number_of_records):
+        key = 92106429 + i
+        records[key] = [key, randint(0, 20), randint(0, 20), randint(0, 20), randint(0, 20)]
+        query.insert(*records[key])
+    db.close()
+
+    # part 2: the changes made before the crash, decided up front so the parent knows what the child did
+    keys = sorted(records.keys())
+    updates = []
+    for _ in range(number_of_updates):
+        updated_columns = [None, None, None, None, None]
+        updated_columns[randint(1, 4)] = randint(0, 20)
+        updates.append((choice(keys), updated_columns))
+    deleted_keys = sample(keys, number_of_deletes)
+    new_keys = [92106429 + number_of_records + i for i in range(number_of_records // 2)]
+    new_records = {key: [key, randint(0, 20), randint(0, 20), randint(0, 20), randint(0, 20)] for key in new_keys}
+
+    pid = os.fork()
+    if pid == 0:
+        db = Database()
+        db.open(path)
+        grades_table = db.get_table('Grades')
+        query = Query(grades_table)
+        for key, updated_columns in updates[:number_of_updates // 2]:
+            query.update(key, *updated_columns)
+        grades_table.merge()
+        for key, updated_columns in updates[number_of_updates // 2:]:
+            query.update(key, *updated_columns)
+        for key in deleted_keys:
+            query.delete(key)
+        for key in new_keys:
+            query.insert(*new_records[key])
+        os._exit(0) # crash: no close, no checkpoint
+    os.waitpid(pid, 0)
+
+    for key, updated_columns in updates:
+        for i, value in enumerate(updated_columns):
+            if value is not None:
+                records[key][i] = value
+    for key in deleted_keys:
+        records.pop(key)
+    records.update(new_records)
+
+    # part 3: reopen and compare against the reference
+    db = Database()
+    db.open(path)
+    grades_table = db.get_table('Grades')
+    query = Query(grades_table)
+
+    for key in keys + new_keys:
+        result = query.select(key, 0, [1, 1, 1, 1, 1])
+        if key not in records:
+            if result:
+                print(storage, 'deleted record came back on', key, ':', result[0])
+            continue
+        error = not result
+        if result:
+            for i, column in enumerate(result[0].columns):
+                if column != records[key][i]:
+                    error = True
+        if error:
+            print(storage, 'select error on', key, ':', result[0] if result else None, ', correct:', records[key])
+    print(storage, "Select finished")
+
+    all_keys = sorted(keys + new_keys)
+    for i in range(0, number_of_aggregates):
+        r = sorted(sample(range(0, len(all_keys)), 2))
+        column_sum = sum(map(lambda x: records[x][2] if x in records else 0, all_keys[r[0]: r[1] + 1]))
+        result = query.sum(all_keys[r[0]], all_keys[r[1]], 2)
+        if column_sum != result:
+            print(storage, 'sum error on [', all_keys[r[0]], ',', all_keys[r[1]], ']: ', result, ', correct: ', column_sum)
+    print(storage, "Aggregate finished")
+
+    db.close()
+    shutil.rmtree(path, ignore_errors=True)
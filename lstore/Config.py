@@ -4,5 +4,8 @@
 #written by Sage for use in page.py 
 PAGE_SIZE = 4096 #
 RECORD_SIZE = 8
+# Every page ends with a small header (format version, flags, record count, LSN) so it can be reloaded without metadata
+PAGE_HEADER_SIZE = 16
+PAGE_FORMAT_VERSION = 1
 #Alvin wrote this to make it easier to find primary column
 META_DATA_COLUMN_SIZE = 5
@@ -1,7 +1,14 @@
-from lstore.page import Page
+from lstore.page import Page, LSN_FIELD, LSN_OFFSET
+from lstore.Config import PAGE_SIZE
 import os
 import io
-from collections import OrderedDict#optimization for dictionary method for speed
+import mmap
+import struct
+import threading
+import time
+from lstore.replacement import REPLACEMENT_POLICIES
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 
 # Implementation Idea:
@@ -12,50 +19,510 @@ from collections import OrderedDict#optimization for dictionary method for speed
 # - after merge and stuff we need to write it back to the disk (page is dirty)
 # - We need file management to update the physical location of the page (file)
 
+MANIFEST_TABLE = struct.Struct('<HI') # page_catalog.bin table block: name length, number of entries
+MANIFEST_ENTRY = struct.Struct('<BIIIq') # page_catalog.bin entry: page type, range index, column, size, last flush lsn
+PAGE_TYPES = ('base', 'tail') # page type <-> the byte stored for it in catalogs
+WARM_ENTRY = struct.Struct('<IBII') # warm_pages.bin entry: rank (0 is the hottest page), page type, range index, column
+PREWARM_BATCH = 32 # pages read per step when the warm set is loaded hottest first
+READ_AHEAD_TRIGGER = 2 # consecutive range indexes a column has to be read in before read-ahead kicks in
+
+
+class PageCatalog(): # hash catalog of every page on the drive so lookups stay O(1) no matter how many pages exist
+    def __init__(self, path, rebuild = None):
+        self.path = path # database folder, the manifest is saved as page_catalog.bin inside it
+        self.rebuild = rebuild # called with the catalog to rediscover pages when there is no manifest to load
+        self.pages = None # (table_name, page_type, r_idx, col) -> (size in bytes, lsn of the last flush), loaded on first use
+
+    def entries(self):
+        if self.pages is None:
+            self.pages = {}
+            if not self.load() and self.rebuild is not None:
+                self.rebuild(self)
+        return self.pages
+
+    def __contains__(self, key):
+        return key in self.entries()
+
+    def __iter__(self):
+        return iter(self.entries())
+
+    def __len__(self):
+        return len(self.entries())
+
+    def get(self, key):
+        # Returns (size, last flush lsn) of a page or None if it was never written
+        return self.entries().get(key)
+
+    def record(self, key, size, lsn):
+        # Called whenever a page is written to the drive
+        self.entries()[key] = (size, lsn)
+
+    def load(self):
+        # Reads the manifest saved by the last clean close. The manifest is removed once loaded so a crash before
+        # the next save makes the next open rebuild the catalog instead of trusting a stale one
+        manifest_path = self.path + "/page_catalog.bin"
+        if not os.path.exists(manifest_path):
+            return False
+        manifest_file = io.open(manifest_path, 'rb')
+        manifest = manifest_file.read()
+        manifest_file.close()
+        position = 0
+        while position < len(manifest):
+            name_length, count = MANIFEST_TABLE.unpack_from(manifest, position)
+            position += MANIFEST_TABLE.size
+            table_name = manifest[position:position + name_length].decode()
+            position += name_length
+            for type_code, r_idx, col, size, lsn in MANIFEST_ENTRY.iter_unpack(manifest[position:position + count * MANIFEST_ENTRY.size]):
+                self.pages[(table_name, PAGE_TYPES[type_code], r_idx, col)] = (size, lsn)
+            position += count * MANIFEST_ENTRY.size
+        os.remove(manifest_path)
+        return True
+
+    def save(self):
+        # Writes the catalog grouped by table, called on close
+        if self.pages is None:
+            return # never loaded so whatever is on disk is still correct
+        tables = {}
+        for (table_name, page_type, r_idx, col), (size, lsn) in self.pages.items():
+            tables.setdefault(table_name, []).append(MANIFEST_ENTRY.pack(PAGE_TYPES.index(page_type), r_idx, col, size, lsn))
+        blocks = []
+        for table_name, entries in tables.items():
+            name = table_name.encode()
+            blocks.append(MANIFEST_TABLE.pack(len(name), len(entries)) + name + b''.join(entries))
+        os.makedirs(self.path, exist_ok=True)
+        manifest_path = self.path + "/page_catalog.bin"
+        manifest_file = io.open(manifest_path + ".tmp", 'wb')
+        manifest_file.write(b''.join(blocks))
+        manifest_file.close()
+        os.replace(manifest_path + ".tmp", manifest_path) # swap in the new manifest in one step
+
+
 class DiskManager(): # Iris
     def __init__(self, path):
         self.path = path # File path
-        self.keys = [] # Keep track of a list of keys that's in the drive
+        self.keys = PageCatalog(path, rebuild = self.scan_pages) # Keep track of the keys that are in the drive
+        self.logged = False # a write-ahead log is in front of every write, set by BufferPool.use_wal
 
     # This class should help with the transition of a page from disk (physical file) to the bufferpool (RAM)
 
     def write_page(self, table_name, page_type, r_idx, col, page): # Iris
         # Creates a new file with the inputted information, this input is also the key of the page
         key = table_name + "/" + page_type + "/range_" + str(r_idx) + "/col_" + str(col) + ".bin"
-        if (table_name, page_type, r_idx, col) not in self.keys:
-            self.keys.append((table_name, page_type, r_idx, col)) # Appends the key into a list so it can be used in bufferpool later
         file = self.path + "/" + key
-        os.makedirs(os.path.dirname(file), exist_ok=True)
+        if (table_name, page_type, r_idx, col) not in self.keys:
+            os.makedirs(os.path.dirname(file), exist_ok=True) # only a brand new page can need its folder created
         file_open = io.open(file, 'wb') # Opens a file (page) prepares to write it
         file_open.write(page.data) # We input the page (from Page.py) into write_page so we can write the data (that should be written in page.py) into the disk
         file_open.close() # Once the updated data is written back into the disk, close the file
+        self.keys.record((table_name, page_type, r_idx, col), len(page.data), page.lsn) # Records the key so it can be used in bufferpool later
 
         # Note: if file path doesn't exist, it writes a new file at that path (new page)
 
     def get_page(self, table_name, page_type, r_idx, col): # Iris
-        key = table_name + "/" + page_type + "/range_" + str(r_idx) + "/col_" + str(col) + ".bin"
         if (table_name, page_type, r_idx, col) not in self.keys:
-            self.keys.append((table_name, page_type, r_idx, col)) # appends the key into a list so it can be used in bufferpool later
-        file = self.path + "/" + key
-        if not os.path.exists(file):
-            # If the file path does not exist, then return none
+            # If the page was never written then return none, no need to ask the file system
             return None
-        page = Page(capacity = 512) # Set standard 2 bytes capacity
+        key = table_name + "/" + page_type + "/range_" + str(r_idx) + "/col_" + str(col) + ".bin"
+        file = self.path + "/" + key
+        page = Page() # record count and lsn come back with the data from the page header
         file_open = io.open(file, 'rb') # Opens a file (page) prepares it for read 
         page.data = bytearray(file_open.read()) # Specified bytes
         file_open.close() # Once page is read, file is closed, but the page is now in the buffer pool
         return page
-        
+
+    def write_pages(self, pages):
+        # Writes a batch of (key, page) pairs, one file each so there is nothing to coalesce here
+        for key, page in pages:
+            self.write_page(*key, page)
+
+    def get_pages(self, keys):
+        # Reads a batch of pages, returns key -> page for the ones that exist
+        # Files are read in path order so pages of the same folder are read together
+        pages = {}
+        for key in sorted(keys):
+            page = self.get_page(*key)
+            if page is not None:
+                pages[key] = page
+        return pages
+
+    def snapshot(self, page):
+        # Copy of a page that another thread can write out while queries keep changing the original
+        copy = Page()
+        copy.data = bytearray(page.data)
+        return copy
+
+    def scan_pages(self, catalog):
+        # Rebuilds the catalog from the page files themselves (no manifest, e.g. after a crash)
+        if self.path is None or not os.path.isdir(self.path):
+            return
+        for folder, subfolders, files in os.walk(self.path):
+            parts = os.path.relpath(folder, self.path).split(os.sep)
+            if len(parts) != 3 or parts[1] not in PAGE_TYPES or not parts[2].startswith("range_"):
+                continue
+            for file in files:
+                if file.startswith("col_") and file.endswith(".bin"):
+                    key = (parts[0], parts[1], int(parts[2][6:]), int(file[4:-4]))
+                    page_file = io.open(folder + "/" + file, 'rb')
+                    page_file.seek(LSN_OFFSET)
+                    lsn = LSN_FIELD.unpack(page_file.read(LSN_FIELD.size))[0] # the lsn in the page header, recovery keeps new lsns above it
+                    page_file.close()
+                    catalog.pages[key] = (os.path.getsize(folder + "/" + file), lsn)
+
+    def sync(self):
+        # Makes every page written so far durable, the page files are already closed so the whole file system is synced
+        if hasattr(os, 'sync'):
+            os.sync()
+
+    def close(self):
+        # Every file is opened and closed per page so only the catalog needs saving
+        self.keys.save()
+
+
+SEGMENT_PAGES = 1 << 18 # pages per segment file (1 GiB of 4kb pages) before the table starts a new segment
+SEGMENT_GROWTH = 256 # pages preallocated at a time whenever a segment runs out of room (also the size of one mmap chunk)
+CATALOG_ENTRY = struct.Struct('<BIIQ') # catalog.bin entry: page type, range index, column, slot number
+
+
+class TableSegments(): # open segment descriptors and slot allocation for one table
+    def __init__(self, path):
+        self.path = path # folder holding this table's segment files and catalog
+        os.makedirs(path, exist_ok=True)
+        self.fds = [] # os level descriptors for each segment file, kept open for pread/pwrite
+        self.allocated = [] # bytes preallocated in each segment file
+        self.slots = {} # (page_type, r_idx, col) -> slot number across the table's segments
+        catalog_path = path + "/catalog.bin"
+        if os.path.exists(catalog_path):
+            catalog_file = io.open(catalog_path, 'rb')
+            catalog = catalog_file.read()
+            catalog_file.close()
+            # a torn entry at the end (crash mid append) is dropped by only unpacking whole entries
+            catalog = catalog[:len(catalog) - len(catalog) % CATALOG_ENTRY.size]
+            for type_code, r_idx, col, slot in CATALOG_ENTRY.iter_unpack(catalog):
+                self.slots[(PAGE_TYPES[type_code], r_idx, col)] = slot
+        self.next_slot = max(self.slots.values()) + 1 if self.slots else 0
+        self.catalog = io.open(catalog_path, 'ab') # new slots are appended to the catalog as they are handed out
+
+    def segment(self, seg):
+        # Returns the descriptor of segment number seg, opening (and creating) segment files up to it
+        while len(self.fds) <= seg:
+            fd = os.open(self.path + "/segment_" + str(len(self.fds)) + ".dat", os.O_RDWR | os.O_CREAT, 0o644)
+            self.fds.append(fd)
+            self.allocated.append(os.fstat(fd).st_size)
+        return self.fds[seg]
+
+    def locate(self, slot):
+        # Maps a slot number to (descriptor, byte offset in that segment)
+        seg, idx = divmod(slot, SEGMENT_PAGES)
+        return self.segment(seg), idx * PAGE_SIZE
+
+    def allocate(self, key):
+        # Hands out the next free slot for a page key, preallocating segment space in big chunks so the file rarely grows
+        slot = self.next_slot
+        self.next_slot += 1
+        seg, idx = divmod(slot, SEGMENT_PAGES)
+        fd = self.segment(seg)
+        if (idx + 1) * PAGE_SIZE > self.allocated[seg]:
+            # grow to the next whole chunk so the mmap backend can map every chunk at a fixed size
+            size = min(SEGMENT_PAGES, (idx // SEGMENT_GROWTH + 1) * SEGMENT_GROWTH) * PAGE_SIZE
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(fd, 0, size)
+            else:
+                os.ftruncate(fd, size)
+            self.allocated[seg] = size
+        self.slots[key] = slot
+        self.catalog.write(CATALOG_ENTRY.pack(PAGE_TYPES.index(key[0]), key[1], key[2], slot))
+        self.catalog.flush()
+        return slot
+
+    def page_lsn(self, slot):
+        # Reads just the lsn out of the header of the page in slot
+        fd, offset = self.locate(slot)
+        header = os.pread(fd, LSN_FIELD.size, offset + LSN_OFFSET)
+        return LSN_FIELD.unpack(header)[0] if len(header) == LSN_FIELD.size else 0 # past the end: never written
+
+    def sync(self):
+        self.catalog.flush()
+        os.fsync(self.catalog.fileno())
+        for fd in self.fds:
+            os.fsync(fd)
+
+    def close(self):
+        self.catalog.close()
+        for fd in self.fds:
+            os.close(fd)
+        self.fds = []
+        self.allocated = []
+
+
+class SegmentDiskManager(DiskManager): # same interface as DiskManager but one set of segment files per table
+    def __init__(self, path):
+        self.path = path # File path
+        self.tables = {} # table_name -> TableSegments
+        self.lock = threading.RLock() # slot allocation and opening segments can happen from the background flusher too
+        self.keys = PageCatalog(path, rebuild = self.scan_pages) # Keep track of the keys that have a slot on the drive
+        self.logged = False # a write-ahead log is in front of every write, set by BufferPool.use_wal
+        if path is not None and os.path.isdir(path):
+            # Open every table's slot catalog up front so keys covers the whole drive
+            for table_name in os.listdir(path):
+                if os.path.exists(path + "/" + table_name + "/catalog.bin"):
+                    self.table_segments(table_name)
+
+    def table_segments(self, table_name):
+        segments = self.tables.get(table_name)
+        if segments is None:
+            with self.lock:
+                segments = self.tables.get(table_name)
+                if segments is None:
+                    # First touch of this table: open its segments and load the page catalog
+                    segments = TableSegments(self.path + "/" + table_name)
+                    for page_type, r_idx, col in segments.slots:
+                        if (table_name, page_type, r_idx, col) not in self.keys: # keep the flush lsn if the manifest had it
+                            # no manifest (crash): the lsn comes from the page header so recovery keeps new lsns above it
+                            slot = segments.slots[(page_type, r_idx, col)]
+                            self.keys.record((table_name, page_type, r_idx, col), PAGE_SIZE, segments.page_lsn(slot))
+                    self.tables[table_name] = segments
+        return segments
+
+    def page_runs(self, pages, allocate = True):
+        # Resolves (key, page) pairs to slots (allocating new ones) and groups pages that sit in consecutive slots
+        # of the same chunk so they can go out in one call. Returns (segments, first slot, [pages]) in slot order
+        # With allocate = False keys without a slot are left out, reads pass (key, key) pairs to get runs of keys
+        located = []
+        with self.lock:
+            for key, page in pages:
+                segments = self.table_segments(key[0])
+                slot = segments.slots.get(key[1:])
+                if slot is None:
+                    if not allocate:
+                        continue
+                    # New page: give it the next slot in the segment files and record it in the catalog
+                    slot = segments.allocate(key[1:])
+                located.append((key[0], slot, segments, page))
+        located.sort(key = lambda item: (item[0], item[1]))
+        runs = []
+        for table_name, slot, segments, page in located:
+            if runs and runs[-1][0] is segments and runs[-1][1] + len(runs[-1][2]) == slot and slot % SEGMENT_GROWTH != 0:
+                runs[-1][2].append(page)
+            else:
+                runs.append((segments, slot, [page]))
+        return runs
+
+    def scan_pages(self, catalog):
+        # catalog.bin of each table is the source of truth for which pages exist, table_segments fills them in
+        pass
+
+    def write_page(self, table_name, page_type, r_idx, col, page):
+        self.write_pages([((table_name, page_type, r_idx, col), page)])
+
+    def write_pages(self, pages):
+        # Adjacent slots are written with a single pwritev, everything else is one positioned write per page
+        for segments, slot, run in self.page_runs(pages):
+            with self.lock:
+                fd, offset = segments.locate(slot)
+            if len(run) > 1 and hasattr(os, 'pwritev'):
+                os.pwritev(fd, [page.data for page in run], offset)
+            else:
+                for page in run:
+                    os.pwrite(fd, page.data, offset) # one positioned write on an already open descriptor
+                    offset += PAGE_SIZE
+        for key, page in pages:
+            self.keys.record(key, PAGE_SIZE, page.lsn)
+
+    def get_page(self, table_name, page_type, r_idx, col):
+        segments = self.table_segments(table_name)
+        slot = segments.slots.get((page_type, r_idx, col))
+        if slot is None:
+            # The page was never written to this table's segments
+            return None
+        fd, offset = segments.locate(slot)
+        page = Page()
+        page.data = bytearray(os.pread(fd, PAGE_SIZE, offset)) # one positioned read, no open/close per page
+        return page
+
+    def get_pages(self, keys):
+        # Reads a batch of pages in slot order, adjacent slots come in with a single preadv
+        pages = {}
+        for segments, slot, run in self.page_runs([(key, key) for key in keys], allocate = False):
+            with self.lock:
+                fd, offset = segments.locate(slot)
+            buffers = [bytearray(PAGE_SIZE) for key in run]
+            if len(run) > 1 and hasattr(os, 'preadv'):
+                os.preadv(fd, buffers, offset)
+            else:
+                for buffer in buffers:
+                    buffer[:] = os.pread(fd, PAGE_SIZE, offset)
+                    offset += PAGE_SIZE
+            for key, buffer in zip(run, buffers):
+                page = Page()
+                page.data = buffer
+                pages[key] = page
+        return pages
+
+    def sync(self):
+        # fsyncs every segment file and slot catalog
+        with self.lock:
+            for segments in self.tables.values():
+                segments.sync()
+
+    def close(self):
+        # Closes every open segment descriptor and catalog file
+        for segments in self.tables.values():
+            segments.close()
+        self.tables = {}
+        self.keys.save()
+
+
+class MmapDiskManager(SegmentDiskManager): # segment files, but pages are slices of a memory map instead of copies
+    # Without a write-ahead log a page's data is a view of the mapping: a cold read is just a page fault, there is no
+    # read call and no copy. With a log (logged is set by BufferPool.use_wal) pages are private copies taken out of
+    # the mapping instead, the kernel can write a mapped page back whenever it likes so a page changed in place could
+    # reach the disk before its log record. They only go back into the mapping in write_pages, after write_out
+    # flushed the log
+    def __init__(self, path):
+        super().__init__(path)
+        # (segments path, segment, chunk) -> mmap of SEGMENT_GROWTH pages
+        # chunks are mapped separately so a growing segment never has to be remapped while pages still point into it
+        self.maps = {}
+
+    def page_view(self, segments, slot):
+        # Returns (chunk mmap, offset in chunk) holding the given slot, mapping the chunk on first use
+        seg, idx = divmod(slot, SEGMENT_PAGES)
+        chunk, idx = divmod(idx, SEGMENT_GROWTH)
+        chunk_map = self.maps.get((segments.path, seg, chunk))
+        if chunk_map is None:
+            with self.lock:
+                chunk_map = self.maps.get((segments.path, seg, chunk))
+                if chunk_map is None:
+                    fd = segments.segment(seg)
+                    chunk_map = mmap.mmap(fd, SEGMENT_GROWTH * PAGE_SIZE, offset = chunk * SEGMENT_GROWTH * PAGE_SIZE)
+                    self.maps[(segments.path, seg, chunk)] = chunk_map
+        return chunk_map, idx * PAGE_SIZE
+
+    def page_data(self, chunk_map, offset):
+        # What a page read from offset in chunk_map holds: the mapping itself, or a copy of it when there is a log
+        if self.logged:
+            return bytearray(chunk_map[offset:offset + PAGE_SIZE])
+        return memoryview(chunk_map)[offset:offset + PAGE_SIZE] # no read and no copy, the first access just faults the page in
+
+    def write_pages(self, pages):
+        # Runs of adjacent pages share a chunk, so each run is a single msync
+        for segments, slot, run in self.page_runs(pages):
+            chunk_map, offset = self.page_view(segments, slot)
+            for i, page in enumerate(run):
+                if not (isinstance(page.data, memoryview) and page.data.obj is chunk_map):
+                    # Private page (new, or a copy because of the log): copy it in, without a log it points at the mapping from now on
+                    chunk_map[offset + i * PAGE_SIZE:offset + (i + 1) * PAGE_SIZE] = page.data
+                    if not self.logged:
+                        page.data = memoryview(chunk_map)[offset + i * PAGE_SIZE:offset + (i + 1) * PAGE_SIZE]
+            chunk_map.flush(offset, len(run) * PAGE_SIZE) # msync just this run's range
+        for key, page in pages:
+            self.keys.record(key, PAGE_SIZE, page.lsn)
+
+    def snapshot(self, page):
+        # Mapped pages are written in place by msync so there is nothing to copy
+        if isinstance(page.data, memoryview):
+            return page
+        return super().snapshot(page)
+
+    def get_page(self, table_name, page_type, r_idx, col):
+        segments = self.table_segments(table_name)
+        slot = segments.slots.get((page_type, r_idx, col))
+        if slot is None:
+            return None
+        chunk_map, offset = self.page_view(segments, slot)
+        page = Page()
+        page.data = self.page_data(chunk_map, offset)
+        return page
+
+    def get_pages(self, keys):
+        # Nothing to read, but the kernel is asked to fault each run of slots in ahead of the first access
+        pages = {}
+        for segments, slot, run in self.page_runs([(key, key) for key in keys], allocate = False):
+            chunk_map, offset = self.page_view(segments, slot)
+            if hasattr(chunk_map, 'madvise') and hasattr(mmap, 'MADV_WILLNEED'):
+                chunk_map.madvise(mmap.MADV_WILLNEED, offset, len(run) * PAGE_SIZE)
+            for i, key in enumerate(run):
+                page = Page()
+                page.data = self.page_data(chunk_map, offset + i * PAGE_SIZE)
+                pages[key] = page
+        return pages
+
+    def close(self):
+        for chunk_map in self.maps.values():
+            chunk_map.flush()
+            try:
+                chunk_map.close()
+            except BufferError:
+                # pages handed out earlier still point into this chunk, it gets unmapped once they are gone
+                pass
+        self.maps = {}
+        super().close()
+
+
+STORAGE_BACKENDS = {'file': DiskManager, 'segment': SegmentDiskManager, 'mmap': MmapDiskManager} # storage option -> disk manager class
+# ('mmap' pages are only zero copy views of the mapping when there is no write-ahead log, see MmapDiskManager)
+
 
 class BufferPool():
-    def __init__(self, capacity=100, path = None):
-        self.disk_manager = DiskManager(path) # Iris: initializes diskmanager so we can pull pages into bufferpool
+    def __init__(self, capacity=100, path = None, storage = 'file', background_flush = False,
+                 dirty_ratio = 0.25, dirty_age = 1.0, clean_frames = 8, flush_interval = 0.05, replacement = 'lru',
+                 buffer_bytes = None, read_ahead = 0, io_threads = 2):
+        # buffer_bytes sizes the pool in memory instead of pages (capacity is ignored when it is given), one pool is
+        # shared by every table and each table gets a fair share of it (see set_quota to give a table a fixed amount)
+        # storage picks how pages are laid out on disk: 'file' is one .bin file per page, 'segment' is a few big files per table
+        # and 'mmap' is the segment layout with pages served straight out of a memory map (copied out of it once
+        # use_wal puts a log in front of the writes)
+        # background_flush starts a thread that trickles dirty pages to disk so eviction rarely has to write:
+        #   dirty_ratio: once more than this fraction of the pool is dirty the oldest dirty pages are written
+        #   dirty_age: seconds a page may stay dirty before it is written
+        #   clean_frames: how many frames at the cold end of the LRU order are kept clean for eviction
+        #   flush_interval: seconds between flusher passes
+        # replacement picks which page gets evicted: 'lru', 'clock' or '2q' (scan resistant), or any policy object
+        # with the methods described in replacement.py
+        # read_ahead is how many page ranges past a sequential scan get loaded early on io_threads background
+        # threads (0 turns it off), see track_access and read_ahead_hint
+        if storage not in STORAGE_BACKENDS:
+            raise ValueError("Unknown storage backend: " + str(storage))
+        self.storage = storage
+        self.disk_manager = STORAGE_BACKENDS[storage](path) # Iris: initializes diskmanager so we can pull pages into bufferpool
         # Initializes buffer pool and sets capacity for it
-        # Enable LRU eviction with oldest entry at the front
-        self.pool = OrderedDict() # Key calls to the page (value) of pool --> also acts as a key to the page for storage
+        self.pool = {} # Key calls to the page (value) of pool --> also acts as a key to the page for storage
         # Key template: table_name/page_type/rangeindex/column
-        self.buffer_capacity = capacity
-        self.dirty = set()
+        if buffer_bytes is not None:
+            capacity = max(1, buffer_bytes // PAGE_SIZE)
+        self.buffer_capacity = capacity # in frames, every frame holds one PAGE_SIZE page
+        self.buffer_bytes = capacity * PAGE_SIZE
+        self.table_frames = {} # table_name -> frames that table holds right now
+        self.quotas = {} # table_name -> frames reserved for that table by set_quota
+        if isinstance(replacement, str):
+            if replacement not in REPLACEMENT_POLICIES:
+                raise ValueError("Unknown replacement policy: " + replacement)
+            replacement = REPLACEMENT_POLICIES[replacement](capacity)
+        self.policy = replacement # decides the eviction order, the pool itself is just a dict
+        self.hits = 0 # get_page calls answered from the pool
+        self.misses = 0 # get_page calls that had to go to the disk manager
+        self.dirty = {} # key -> time the page first became dirty, oldest first
+        self.lock = threading.RLock() # guards pool and dirty since the flusher thread uses them too
+        self.io_done = threading.Condition(self.lock) # notified whenever the flusher finishes a batch
+        self.writing = set() # keys the flusher is writing out right now
+        self.dirty_ratio = dirty_ratio
+        self.dirty_age = dirty_age
+        self.clean_frames = clean_frames
+        self.flush_interval = flush_interval
+        self.flusher = None
+        self.flush_wakeup = threading.Event()
+        self.stopping = False
+        self.prewarmer = None # thread loading the warm set saved by the last close, see prewarm
+        self.prewarm_seen = None # keys in the pool when prewarming started and every key added or evicted since, never prewarmed
+        self.read_ahead = read_ahead
+        self.io_threads = io_threads
+        self.io_pool = None # read-ahead thread pool, started on the first read-ahead
+        self.reading = set() # keys a read-ahead thread is loading right now, get_page waits for these instead of reading them twice
+        self.streams = {} # (table_name, page_type, col) -> [last range index, ranges read in a row, furthest range scheduled]
+        self.wal = None # the database's write-ahead log, set by use_wal, see write_out
+        if background_flush:
+            self.flusher = threading.Thread(target = self.flush_loop, daemon = True)
+            self.flusher.start()
 
 
         
@@ -64,73 +531,432 @@ class BufferPool():
         '''
     def get_page(self, table_name, page_type, r_idx, col): # Sage get page standerdized implimentation 
         key = (table_name, page_type, r_idx, col) # Set key to conditions in get page
-        if key in self.pool: # Check if key is in pool to skip checking disk too ie slightly faster
-            self.pool.move_to_end(key)
-            return self.pool[key] # Because we found it in disk 
-        # Not in pool, try disk
-        page = self.disk_manager.get_page(table_name, page_type, r_idx, col) # Try get page function in disk manager 
-        if page is None: # Not there
-            return None
-        self.buffer_insert(key, page) # Run an insert on the key and page to bufferpool
-        return page
+        with self.lock:
+            if self.read_ahead:
+                self.track_access(key)
+            while key in self.reading: # already on its way in, wait for it rather than reading it a second time
+                self.io_done.wait()
+            if key in self.pool: # Check if key is in pool to skip checking disk too ie slightly faster
+                self.hits += 1
+                self.policy.touch(key)
+                return self.pool[key] # Because we found it in disk 
+            # Not in pool, try disk
+            self.misses += 1
+            page = self.disk_manager.get_page(table_name, page_type, r_idx, col) # Try get page function in disk manager 
+            if page is None: # Not there
+                return None
+            self.buffer_insert(key, page) # Run an insert on the key and page to bufferpool
+            return page
         
-    def put_page(self, table_name, page_type, r_idx, col, page): # Put page in bufferpool if it exists
+    def put_page(self, table_name, page_type, r_idx, col, page, dirty = True): # Put page in bufferpool if it exists
+        # dirty = False puts back a page that was only read so it doesn't cost a write later
         key = (table_name, page_type, r_idx, col) # Grab key name 
-        if key in self.pool: # Check key in pool
-            self.pool[key] = page
-            self.pool.move_to_end(key) # Move to end method in ordered dict for optimization of dictionary 
-        else:
-            self.buffer_insert(key, page) # Insert it if it is not in pool
-        self.mark_dirty(key) # Mark the page dirty 
+        with self.lock:
+            if key in self.pool: # Check key in pool
+                self.pool[key] = page
+                self.policy.touch(key)
+            else:
+                self.buffer_insert(key, page) # Insert it if it is not in pool
+            if dirty:
+                self.mark_dirty(key) # Mark the page dirty 
+
+    def fetch(self, key):
+        # Gets a page and pins it: it can't be evicted until every fetch is matched by an unpin
+        # Returns None (and pins nothing) if the page doesn't exist
+        with self.lock:
+            page = self.get_page(*key)
+            if page is not None:
+                page.pin_count += 1
+            return page
+
+    def unpin(self, key, dirty = False):
+        # Releases one pin taken by fetch, dirty = True if the caller changed the page while holding it
+        with self.lock:
+            page = self.pool[key]
+            page.pin_count -= 1
+            if dirty:
+                self.mark_dirty(key)
+
+    @contextmanager
+    def pinned(self, key, dirty = False):
+        # with pool.pinned(key, dirty=True) as page: ... keeps the page pinned for the whole block
+        page = self.fetch(key)
+        if page is None:
+            raise KeyError(key)
+        try:
+            yield page
+        finally:
+            self.unpin(key, dirty)
 
     # Flushes all the pages to disk 
     def flush_all(self):
         # Write all dirty pages back to disk (call on shutdown or after merge)
-        for key in list(self.dirty):
-            if key in self.pool:
-                self.disk_manager.write_page(*key, self.pool[key])
-        self.dirty.clear()
+        with self.lock:
+            while self.writing: # let the flusher finish its batch so an older copy can't land after ours
+                self.io_done.wait()
+            self.write_out([(key, self.pool[key]) for key in self.dirty if key in self.pool])
+            self.dirty.clear()
+
+    def close(self):
+        # Stops the flusher, writes back the dirty pages, remembers which pages were hot and releases anything
+        # the disk manager keeps open
+        self.stopping = True
+        if self.prewarmer is not None:
+            self.prewarmer.join()
+            self.prewarmer = None
+        if self.io_pool is not None:
+            self.io_pool.shutdown(wait = True)
+            self.io_pool = None
+        if self.flusher is not None:
+            self.flush_wakeup.set()
+            self.flusher.join()
+            self.flusher = None
+        self.flush_all()
+        self.save_warm_state()
+        self.disk_manager.close()
+
+    def use_wal(self, wal):
+        # Puts a write-ahead log in front of every page write (see write_out), called before any page is loaded
+        self.wal = wal
+        self.disk_manager.logged = True
+
+    def write_out(self, pages):
+        # Every page write goes through here: the log records behind the changes in these pages have to be on disk
+        # before the pages are, or a crash could leave a change on disk that recovery knows nothing about
+        if self.wal is not None and pages:
+            self.wal.flush(max(page.lsn for key, page in pages))
+        self.disk_manager.write_pages(pages)
+
+    def save_warm_state(self):
+        # Writes the keys of the pages in the pool to warm_pages.bin, hottest first in the replacement policy's order,
+        # so the next open can load the working set before queries ask for it
+        path = self.disk_manager.path
+        if path is None or not os.path.isdir(path):
+            return
+        with self.lock:
+            ranked = [key for key in self.policy.ranked() if key in self.disk_manager.keys]
+        tables = {}
+        for rank, (table_name, page_type, r_idx, col) in enumerate(ranked):
+            tables.setdefault(table_name, []).append(WARM_ENTRY.pack(rank, PAGE_TYPES.index(page_type), r_idx, col))
+        blocks = []
+        for table_name, entries in tables.items():
+            name = table_name.encode()
+            blocks.append(MANIFEST_TABLE.pack(len(name), len(entries)) + name + b''.join(entries))
+        warm_path = path + "/warm_pages.bin"
+        warm_file = io.open(warm_path + ".tmp", 'wb')
+        warm_file.write(b''.join(blocks))
+        warm_file.close()
+        os.replace(warm_path + ".tmp", warm_path)
+
+    def load_warm_state(self):
+        # Returns the keys saved by save_warm_state, hottest first (empty if the database was never closed cleanly)
+        path = self.disk_manager.path
+        if path is None or not os.path.exists(path + "/warm_pages.bin"):
+            return []
+        warm_file = io.open(path + "/warm_pages.bin", 'rb')
+        warm = warm_file.read()
+        warm_file.close()
+        ranked = []
+        position = 0
+        while position < len(warm):
+            name_length, count = MANIFEST_TABLE.unpack_from(warm, position)
+            position += MANIFEST_TABLE.size
+            table_name = warm[position:position + name_length].decode()
+            position += name_length
+            for rank, type_code, r_idx, col in WARM_ENTRY.iter_unpack(warm[position:position + count * WARM_ENTRY.size]):
+                ranked.append((rank, (table_name, PAGE_TYPES[type_code], r_idx, col)))
+            position += count * WARM_ENTRY.size
+        ranked.sort()
+        return [key for rank, key in ranked]
+
+    def prewarm(self, sequential = False, background = True):
+        # Loads the warm set saved by the last close into free frames
+        # sequential = False reads it hottest first a batch at a time so the hottest pages are ready soonest,
+        # sequential = True reads the whole set in one pass sorted by where the pages sit on disk (one preadv per
+        # run of adjacent slots with the segment backends) and only then hands the pages to the pool
+        # Only free frames are filled, nothing is ever evicted for a prewarmed page
+        keys = [key for key in self.load_warm_state() if key in self.disk_manager.keys][:self.buffer_capacity]
+        if not keys:
+            return
+        with self.lock:
+            self.prewarm_seen = set(self.pool) # pages already here (e.g. changed by recovery) may be newer than the disk
+        if background:
+            self.prewarmer = threading.Thread(target = self.prewarm_pages, args = (keys, sequential), daemon = True)
+            self.prewarmer.start()
+        else:
+            self.prewarm_pages(keys, sequential)
+
+    def prewarm_pages(self, keys, sequential):
+        try:
+            if sequential:
+                batches = [keys]
+            else:
+                batches = [keys[i:i + PREWARM_BATCH] for i in range(0, len(keys), PREWARM_BATCH)]
+            for batch in batches:
+                if self.stopping:
+                    return
+                pages = self.disk_manager.get_pages(batch) # read outside the lock so queries keep running
+                with self.lock:
+                    for key in reversed(batch): # coldest first so the hottest page ends up the most recently used
+                        if self.buffer_at_capacity():
+                            return
+                        # a page that was in the pool at any point since prewarming started may have been changed
+                        # (and evicted and rewritten) after the prewarmer read it, so only pages nobody touched are added
+                        if key in pages and key not in self.pool and key not in self.prewarm_seen:
+                            self.buffer_insert(key, pages[key])
+        finally:
+            with self.lock:
+                self.prewarm_seen = None
+
+    def flush_loop(self):
+        # Background flusher: wakes up every flush_interval (or early when too much of the pool is dirty)
+        while not self.stopping:
+            self.flush_wakeup.wait(self.flush_interval)
+            self.flush_wakeup.clear()
+            if not self.stopping:
+                self.flush_some()
+
+    def flush_some(self):
+        # One flusher pass: writes pages that are too old, pages over the dirty ratio, and dirty pages at the cold end
+        # of the pool that eviction would pick next. Pages are snapshotted under the lock and written outside of it
+        now = time.monotonic()
+        with self.lock:
+            if not self.dirty:
+                return
+            chosen = []
+            over = len(self.dirty) - int(self.dirty_ratio * self.buffer_capacity)
+            for key, since in self.dirty.items(): # oldest first
+                if over <= 0 and now - since < self.dirty_age:
+                    break
+                chosen.append(key)
+                over -= 1
+            for key in self.policy.coldest(self.clean_frames):
+                if key in self.dirty:
+                    chosen.append(key)
+            batch = self.take_snapshots(chosen)
+        try:
+            self.write_snapshots(batch)
+        except Exception:
+            pass # the pages are dirty again, next pass tries again
+
+    def wait_for_writes(self):
+        # Blocks until the batch the flusher is writing right now (if any) has landed
+        with self.lock:
+            while self.writing:
+                self.io_done.wait()
+
+    def checkpoint_snapshots(self):
+        # Copies every page that is dirty right now, for a checkpoint, and returns the batch for write_snapshots.
+        # The checkpoint takes the copies while queries are held off and writes them once they run again, changes
+        # made after the snapshot just leave the page dirty again
+        with self.lock:
+            while self.writing: # an older flusher batch has to land first, it may hold changes the checkpoint covers
+                self.io_done.wait()
+            return self.take_snapshots(list(self.dirty))
+
+    def checkpoint_pages(self):
+        # Writes every page that is dirty right now
+        self.write_snapshots(self.checkpoint_snapshots())
+
+    def take_snapshots(self, keys):
+        # Called with the lock held: copies the dirty pages among keys and marks them as being written
+        batch = []
+        for key in keys:
+            if key in self.dirty and key in self.pool and key not in self.writing:
+                batch.append((key, self.disk_manager.snapshot(self.pool[key])))
+                self.writing.add(key)
+                del self.dirty[key] # any change after the snapshot marks it dirty again
+        return batch
+
+    def write_snapshots(self, batch):
+        # Writes a batch from take_snapshots without holding the lock, if the write fails the pages are dirty again
+        if not batch:
+            return
+        now = time.monotonic()
+        try:
+            self.write_out(batch) # sorted and coalesced by the disk manager
+        except Exception:
+            with self.lock:
+                for key, page in batch:
+                    self.dirty.setdefault(key, now)
+            raise
+        finally:
+            with self.lock:
+                for key, page in batch:
+                    self.writing.discard(key)
+                self.io_done.notify_all()
+
+    def track_access(self, key):
+        # Read-ahead detection: a column whose pages are asked for in consecutive range indexes is being scanned,
+        # once it is the next read_ahead ranges of that column are loaded in the background, half a window at a time
+        stream = (key[0], key[1], key[3])
+        r_idx = key[2]
+        state = self.streams.get(stream)
+        if state is None:
+            self.streams[stream] = [r_idx, 1, r_idx]
+            return
+        if r_idx == state[0]:
+            return
+        state[1] = state[1] + 1 if r_idx == state[0] + 1 else 1
+        state[0] = r_idx
+        state[2] = max(state[2], r_idx)
+        if state[1] >= READ_AHEAD_TRIGGER and state[2] - r_idx <= self.read_ahead // 2:
+            self.schedule_read(key[0], key[1], key[3], range(state[2] + 1, r_idx + self.read_ahead + 1))
+            state[2] = r_idx + self.read_ahead
+
+    def read_ahead_hint(self, table_name, page_type, cols, start = 0):
+        # Lets a scan say up front that it is about to read these columns range by range from start on,
+        # so read-ahead starts with the first range instead of waiting to notice the pattern
+        if not self.read_ahead:
+            return
+        with self.lock:
+            for col in cols:
+                self.streams[(table_name, page_type, col)] = [start - 1, READ_AHEAD_TRIGGER, start + self.read_ahead - 1]
+                self.schedule_read(table_name, page_type, col, range(start, start + self.read_ahead))
+
+    def schedule_read(self, table_name, page_type, col, ranges):
+        # Hands the pages of these ranges that exist on disk and aren't in the pool yet to the read-ahead threads
+        keys = [(table_name, page_type, r_idx, col) for r_idx in ranges]
+        keys = [key for key in keys if key not in self.pool and key not in self.reading and key in self.disk_manager.keys]
+        if not keys or self.stopping:
+            return
+        self.reading.update(keys)
+        if self.io_pool is None:
+            self.io_pool = ThreadPoolExecutor(max_workers = self.io_threads, thread_name_prefix = 'read-ahead')
+        self.io_pool.submit(self.read_pages, keys)
+
+    def read_pages(self, keys):
+        # Runs on a read-ahead thread: one batched read outside the lock, then the pages join the pool like any miss
+        pages = {}
+        try:
+            pages = self.disk_manager.get_pages(keys)
+        finally:
+            with self.lock:
+                self.reading.difference_update(keys)
+                try:
+                    for key in keys:
+                        if key in pages and key not in self.pool and not self.stopping:
+                            self.buffer_insert(key, pages[key])
+                except Exception:
+                    pass # every frame is pinned, whoever needs the rest will read it themselves
+                self.io_done.notify_all()
+
+    def set_quota(self, table_name, quota_bytes):
+        # Gives a table a fixed share of the pool in bytes (None goes back to the fair share)
+        with self.lock:
+            if quota_bytes is None:
+                self.quotas.pop(table_name, None)
+            else:
+                self.quotas[table_name] = max(1, quota_bytes // PAGE_SIZE)
+
+    def table_share(self, table_name):
+        # Frames a table may hold before its own pages are the ones evicted: its quota if it has one, otherwise an
+        # equal split of what the quotas leave over between the tables that currently have pages in the pool
+        if table_name in self.quotas:
+            return self.quotas[table_name]
+        sharing = [name for name, frames in self.table_frames.items() if frames > 0 and name not in self.quotas]
+        if table_name not in sharing:
+            sharing.append(table_name)
+        return max(1, (self.buffer_capacity - sum(self.quotas.values())) // len(sharing))
+
+    def usage(self):
+        # Bytes of the pool each table is holding
+        with self.lock:
+            return {name: frames * PAGE_SIZE for name, frames in self.table_frames.items() if frames > 0}
+
+    def eviction_tables(self, table_name):
+        # Which tables a new page for table_name may take a frame from: a table over its share pays for its own pages
+        # (so a big scan can't push out other tables), otherwise the tables that are over their share give one up
+        # None means any table
+        if self.table_frames.get(table_name, 0) >= self.table_share(table_name):
+            return {table_name}
+        over = {name for name, frames in self.table_frames.items() if frames > 0 and frames >= self.table_share(name)}
+        return over or None
+
+    def choose_victim(self, tables = None):
+        # Follows the replacement policy, but a clean frame among the first clean_frames candidates is preferred so
+        # eviction doesn't have to write. Pinned frames are never picked and frames the flusher is writing are skipped
+        # so nobody can read the old copy back from disk before the write lands
+        # tables limits the choice to pages of those tables (fair share), if none of them can give a frame any table will do
+        fallback = None
+        looked = 0
+        for key in self.policy.victims():
+            if key in self.writing or self.pool[key].pin_count > 0:
+                continue
+            if tables is not None and key[0] not in tables:
+                continue
+            if key not in self.dirty:
+                return key
+            if fallback is None:
+                fallback = key
+            looked += 1
+            if looked >= self.clean_frames:
+                break
+        if fallback is None:
+            if tables is not None:
+                return self.choose_victim()
+            if not self.writing:
+                raise Exception("Eviction failed: every page in the bufferpool is pinned.")
+            self.io_done.wait() # every candidate is being written, wait for the flusher then look again
+            return self.choose_victim()
+        return fallback
 
     def buffer_insert(self, key, value):  # Nicholas
         # Note from Iris: key is a tuple of (table_name, page_type, r_idx, col)
         if key not in self.pool:  # Checks if requested key is already in buffer pool and only moves forward if key is not in buffer pool
             if self.buffer_at_capacity():  # If bufferpool is at capacity then we must replace our oldest value with a new one
                 # Were going to use Least Recently Used for deciding which page to evict from the buffer pool
-                oldest_key, oldest_page = self.buffer_order.popitem(last = False)
+                oldest_key = self.choose_victim(self.eviction_tables(key[0]))
+                oldest_page = self.pool.pop(oldest_key)
+                self.policy.remove(oldest_key)
+                if self.prewarm_seen is not None:
+                    self.prewarm_seen.add(oldest_key)
+                self.table_frames[oldest_key[0]] -= 1
                 if oldest_key in self.dirty:
                     # If the oldest value in the buffer pool is not written to the storage drive then we need to flush it before eviction
-                    self.disk_manager.write_page(*oldest_key, oldest_page)# Iris: write the page based off the oldest key the pool
-                    self.dirty.discard(oldest_key)
+                    self.write_out([(oldest_key, oldest_page)])# Iris: write the page based off the oldest key the pool
+                    del self.dirty[oldest_key]
             self.pool[key] = value
+            self.policy.insert(key)
+            self.table_frames[key[0]] = self.table_frames.get(key[0], 0) + 1
+            if self.prewarm_seen is not None:
+                self.prewarm_seen.add(key)
 
         elif key in self.pool: # If requested key is already in the buffer pool then we need to 
             self.pool[key] = value
             self.mark_dirty(key)
-            self.pool.move_to_end(key) # Just grabs the value 
+            self.policy.touch(key) # Just grabs the value 
             return self.pool[key]
 
     # buffer_get is used for guaranteeing that we always get a page
     def buffer_get(self, key): # Nicholas and Iris
         # In order to ensure that we always get a page we check the pool (cache) and then the drive if its not in cache
-        if key in self.disk_manager.keys and key in self.pool: # Iris: checks if key is in the drive
-            # Here we just need to reset the requested pages position in the buffer_order and then return it from the buffer pool
-            self.pool.move_to_end(key)
-            return self.pool[key]
-        else:
-            if key not in self.disk_manager.keys:
-                # This is just in case the requested page does not exist in the storage drive either
-                return None
-            # Iris: if key is in drive but not bufferpool, bring it into the bufferpool
-            table_name = key[0] # Since key is a tuple, i'm deconstructing it for disk_manager
-            page_type = key[1]
-            r_idx = key[2]
-            col = key[3]
-            page = self.disk_manager.get_page(table_name, page_type, r_idx, col)
-            self.buffer_insert(key, page)
-            return page  # Returns the page that we are trying to access
+        with self.lock:
+            while key in self.reading:
+                self.io_done.wait()
+            if key in self.pool: # pages that were never flushed yet only live in the pool so check it before the drive catalog
+                # Here we just need to tell the replacement policy it was used and then return it from the buffer pool
+                self.policy.touch(key)
+                return self.pool[key]
+            else:
+                if key not in self.disk_manager.keys:
+                    # This is just in case the requested page does not exist in the storage drive either
+                    return None
+                # Iris: if key is in drive but not bufferpool, bring it into the bufferpool
+                table_name = key[0] # Since key is a tuple, i'm deconstructing it for disk_manager
+                page_type = key[1]
+                r_idx = key[2]
+                col = key[3]
+                page = self.disk_manager.get_page(table_name, page_type, r_idx, col)
+                self.buffer_insert(key, page)
+                return page  # Returns the page that we are trying to access
 
     def mark_dirty(self, key):
-        self.dirty.add(key)  # This tracks whether or not a page has been modified but hasn't been flushed to storage drive
+        # This tracks whether or not a page has been modified but hasn't been flushed to storage drive
+        if key not in self.dirty:
+            self.dirty[key] = time.monotonic()
+            if self.flusher is not None and len(self.dirty) > self.dirty_ratio * self.buffer_capacity:
+                self.flush_wakeup.set() # over the dirty ratio, don't wait for the next interval
 
     def buffer_at_capacity(self):  # Nicholas
         return len(
@@ -148,4 +974,9 @@ class BufferPool():
         if self.is_page_pinned(key):  # Iris: checks if page is pinned before evicting it
             raise Exception("Eviction failed: page is currently being accessed.")
         # Checking if the page is dirty or not is included in buffer_insert, so I won't add it here
-        del self.pool[key]  # Deletes key from buffer pool
+        with self.lock:
+            del self.pool[key]  # Deletes key from buffer pool
+            self.policy.remove(key)
+            if self.prewarm_seen is not None:
+                self.prewarm_seen.add(key)
+            self.table_frames[key[0]] -= 1
@@ -1,9 +1,140 @@
 from lstore.table import Table
-from lstore.page import Page
+from lstore.page_directory import PageDirectory, write_directory
+from lstore.page import Page, MAX_SLOTS
 from lstore.bufferpool import BufferPool
+from lstore.Config import PAGE_FORMAT_VERSION, PAGE_SIZE, RECORD_SIZE
+from lstore.wal import WriteAheadLog
+from BTrees.OOBTree import OOBTree
+from array import array
 import os
+import sys
 import json
 import io
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+
+LEGACY_SLOTS = PAGE_SIZE // RECORD_SIZE # databases saved before pages had a header: 512 big-endian slots per page
+
+class OperationLock(): # held by every table operation, a checkpoint takes it exclusively to take its snapshot
+    # Operations go through a gate first: a checkpoint closes the gate while it waits so operations running back to
+    # back can't keep grabbing the lock before it gets a turn
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.gate = threading.Lock()
+        self.owner = None
+        self.depth = 0
+
+    def __enter__(self):
+        if self.owner != threading.get_ident(): # nested operations of the thread that has it skip the gate
+            with self.gate:
+                pass
+        self.lock.acquire()
+        self.owner = threading.get_ident()
+        self.depth += 1
+
+    def __exit__(self, *exc):
+        self.depth -= 1
+        if self.depth == 0:
+            self.owner = None
+        self.lock.release()
+
+    @contextmanager
+    def exclusive(self):
+        with self.gate, self.lock:
+            yield
+
+# Rewrites a database saved before pages had a header (its metadata.json has no page_format) in the current format
+# and returns its new metadata. Records move to the same position in one long run of 510 slot pages instead of 512
+# slot ones, the slots are byte swapped to native order, num_records goes into each page header and the JSON page
+# directory becomes directory.bin with the moved locations. Tail records and indirection columns only hold rids, so
+# nothing else changes. The new files are built next to the old ones and only swapped in at the end, the old
+# metadata.json stays until then so an interrupted upgrade just starts over on the next open
+def upgrade_legacy(path, meta):
+    for table_data in meta['tables']:
+        legacy = path + "/" + table_data['name'] + ".legacy"
+        if os.path.isdir(legacy): # an earlier upgrade stopped after moving this table: the old files are the real ones
+            shutil.rmtree(path + "/" + table_data['name'], ignore_errors = True)
+            os.rename(legacy, path + "/" + table_data['name'])
+    tables = []
+    for table_data in meta['tables']:
+        if 'page_directory' not in table_data or 'base_num_records' not in table_data:
+            raise Exception("Database at " + path + " was saved with an unsupported page format")
+        name = table_data['name']
+        total_columns = table_data['num_columns'] + 4
+        upgrade = path + "/" + name + ".upgrade"
+        shutil.rmtree(upgrade, ignore_errors = True)
+        first_slots = {} # page type -> position of each old range's first record in the run of all its records
+        for page_type in ('base', 'tail'):
+            columns = [array('q') for col in range(total_columns)]
+            first_slots[page_type] = []
+            for r_idx, counts in enumerate(table_data.get(page_type + '_num_records', [])):
+                first_slots[page_type].append(len(columns[0]))
+                count = max(counts) if counts else 0 # every record of a range is written to all of its columns
+                for col in range(total_columns):
+                    data = bytes(LEGACY_SLOTS * RECORD_SIZE)
+                    page_path = path + "/" + name + "/" + page_type + "/range_" + str(r_idx) + "/col_" + str(col) + ".bin"
+                    if os.path.exists(page_path):
+                        page_file = io.open(page_path, 'rb')
+                        data = page_file.read().ljust(LEGACY_SLOTS * RECORD_SIZE, b'\0')[:LEGACY_SLOTS * RECORD_SIZE]
+                        page_file.close()
+                    words = array('q', data)
+                    if sys.byteorder == 'little':
+                        words.byteswap()
+                    columns[col].extend(words[:count])
+            ranges = -(-len(columns[0]) // MAX_SLOTS)
+            if page_type == 'base':
+                ranges = max(ranges, 1) # a table always has a base range to insert into
+            for r_idx in range(ranges):
+                os.makedirs(upgrade + "/" + page_type + "/range_" + str(r_idx), exist_ok = True)
+                for col in range(total_columns):
+                    page = Page()
+                    values = columns[col][r_idx * MAX_SLOTS:(r_idx + 1) * MAX_SLOTS]
+                    page.update_many(0, values)
+                    page.num_records = len(values)
+                    page_file = io.open(upgrade + "/" + page_type + "/range_" + str(r_idx) + "/col_" + str(col) + ".bin", 'wb')
+                    page_file.write(page.data)
+                    page_file.close()
+            table_data['cur_' + page_type + '_range_index'] = ranges - 1
+        directory = PageDirectory()
+        for rid, (page_type, r_idx, offset) in table_data.pop('page_directory').items():
+            position = first_slots[page_type][r_idx] + offset // RECORD_SIZE
+            directory[int(rid)] = (page_type, position // MAX_SLOTS, position % MAX_SLOTS * RECORD_SIZE)
+        write_directory(upgrade, directory.words, time.time_ns())
+        table_data.pop('base_num_records')
+        table_data.pop('tail_num_records', None)
+        tables.append(name)
+    for name in tables:
+        if os.path.isdir(path + "/" + name):
+            os.rename(path + "/" + name, path + "/" + name + ".legacy")
+        os.rename(path + "/" + name + ".upgrade", path + "/" + name)
+    meta['storage'] = 'file'
+    meta['page_format'] = PAGE_FORMAT_VERSION
+    write_metadata(path, meta)
+    for name in tables:
+        shutil.rmtree(path + "/" + name + ".legacy", ignore_errors = True)
+    return meta
+
+# writes metadata.json in one step, a crash while writing leaves the old metadata (and the log) in place
+def write_metadata(path, meta):
+    meta_path = path + '/metadata.json'
+    meta_file = io.open(meta_path + '.tmp', 'w')
+    json.dump(meta, meta_file) # converts Python data structures into the standardized JSON format
+    meta_file.flush()
+    os.fsync(meta_file.fileno())
+    meta_file.close()
+    os.replace(meta_path + '.tmp', meta_path)
+
+# storage layout of a database that has pages but no metadata.json (written before layouts were recorded at creation),
+# None when there are no pages: segment layouts keep a catalog.bin per table, the file layout a folder per page type
+def find_storage(path):
+    for name in os.listdir(path):
+        if os.path.exists(path + "/" + name + "/catalog.bin"):
+            return 'segment'
+        if os.path.isdir(path + "/" + name + "/base"):
+            return 'file'
+    return None
 
 class Database():
 
@@ -11,28 +142,71 @@ class Database():
         self.tables = []
         self.path = None
         self.bufferpool = None
+        self.wal = None
+        self.op_lock = OperationLock() # held by every table operation, a checkpoint holds it while it takes its snapshot
+        self.checkpoint_lock = threading.Lock() # one checkpoint at a time
+        self.checkpointer = None
+        self.checkpoint_stop = threading.Event()
 
     # loads all the table data from disk back into memory so the database can pick up where it left off
     # should load pages into the bufferpool instead of directly into the table
-    def open(self, path): # naomi
+    # storage picks the on disk page layout ('file', 'segment' or 'mmap'), by default an existing database keeps the layout it was saved with
+    # 'segment' and 'mmap' share the same files so a database can be switched between them to compare, any other switch raises
+    # background_flush starts the bufferpool's write-back thread so queries rarely wait on eviction writes
+    # replacement is the bufferpool eviction policy: 'lru', 'clock' or '2q'
+    # buffer_bytes is the memory budget of the one bufferpool all tables share (100 pages by default)
+    # prewarm reloads the pages that were hot at the last close on a background thread, prewarm_sequential reads them
+    # in one pass in disk order instead of hottest first
+    # read_ahead is how many page ranges ahead of a scan get loaded on io_threads background threads (0 turns it off)
+    # wal keeps a write-ahead log so a crash loses nothing that was committed, the log is replayed here on the next open
+    # sync is when a commit counts as durable: 'commit' (fsync, shared by concurrent commits), 'interval' or 'off' (see wal.py)
+    # checkpoint_interval is how many seconds apart background checkpoints run (None turns them off), a checkpoint also
+    # runs as soon as the log grows past checkpoint_log_bytes
+    # indexes saved by the last close are loaded back as they were, they are only rebuilt from the pages after a crash
+    def open(self, path, storage = None, background_flush = False, replacement = 'lru', buffer_bytes = None,
+             prewarm = True, prewarm_sequential = False, read_ahead = 8, io_threads = 2, wal = True, sync = 'commit',
+             checkpoint_interval = 30.0, checkpoint_log_bytes = 16 << 20): # naomi
         self.path = path
-        # create bufferpool when database is opened
-        self.bufferpool = BufferPool(capacity=100, path=path)
 
         # create the folder where all our database files will live
         if not os.path.exists(path):
             os.makedirs(path)
         
-        # if there's no metadata file, this is a brand new database, so nothing to load
         meta_path = path + '/metadata.json' # builds the full path to where the metadata file would be
-        if not os.path.exists(meta_path):
-            return
+        if os.path.exists(meta_path):
+            # read the metadata file which has all the saved table info
+            meta_file = io.open(meta_path, 'r')
+            meta = json.load(meta_file) # converts the JSON file into a python dict
+            meta_file.close()
+            if 'page_format' not in meta:
+                meta = upgrade_legacy(path, meta) # saved by the first version, before pages had a header
+        else:
+            # brand new database, or one that crashed before its first checkpoint (the log still has its tables):
+            # the layout is recorded right away so reopening it can't pick a different one
+            found = find_storage(path)
+            if found is None or (found == 'segment' and storage == 'mmap'):
+                found = storage or 'file'
+            meta = {'tables': [], 'storage': found, 'page_format': PAGE_FORMAT_VERSION}
+            write_metadata(path, meta)
+        saved_storage = meta.get('storage', 'file') # databases saved before storage options existed use one file per page
+        if storage is None:
+            storage = saved_storage
+        elif storage != saved_storage and {storage, saved_storage} != {'segment', 'mmap'}:
+            # any other layout would see no pages at all and the next checkpoint would overwrite the metadata
+            raise Exception("Database at " + path + " was saved with storage '" + saved_storage + "', not '" + storage + "'")
+        if meta.get('page_format') != PAGE_FORMAT_VERSION:
+            # pages without a header (or from another layout) can't be read back correctly
+            raise Exception("Database at " + path + " was saved with an unsupported page format")
 
-        # read the metadata file which has all the saved table info
-        meta_file = io.open(meta_path, 'r')
-        meta = json.load(meta_file) # converts the JSON file into a python dict
-        meta_file.close()
+        # create bufferpool when database is opened
+        self.bufferpool = BufferPool(capacity=100, path=path, storage=storage, background_flush=background_flush, replacement=replacement, buffer_bytes=buffer_bytes,
+                                     read_ahead=read_ahead, io_threads=io_threads)
+
+        if wal:
+            self.wal = WriteAheadLog(path, sync = sync)
+            self.bufferpool.use_wal(self.wal)
 
+        saved_indexes = {} # table name -> (indexed columns, checkpoint lsn the index files were saved at)
         # recreate the table object with the same name, columns, and key as before
         for table_data in meta['tables']: # # loop through each table that was saved
             # get all the saved table info for this table
@@ -40,19 +214,23 @@ class Database():
             num_columns = table_data['num_columns']
             key = table_data['key']
             rid = table_data['rid']
-            page_directory = table_data['page_directory']
     
             # recreate the table object with the same info as before
-            table = Table(name, num_columns, key, loading = True, db_path=path)
-            table.bufferpool = self.bufferpool # give the table access to the shared buffer pool
+            table = Table(name, num_columns, key, loading = True, db_path=path, bufferpool=self.bufferpool) # give the table access to the shared buffer pool
+            self.attach(table)
             
             # restore the rid counter so we dont reuse old rids
             table.rid = rid
-            # restore page directory, converting keys back to integers and values back to tuples
-            directory = {}
-            for k, v in page_directory.items():
-                directory[int(k)] = tuple(v) 
-            table.page_directory = directory
+            if 'page_directory' in table_data:
+                # saved before checkpoints existed: restore page directory, converting keys back to integers and values back to tuples
+                # the first checkpoint writes it out as this table's directory.bin
+                directory = PageDirectory()
+                for k, v in table_data['page_directory'].items():
+                    directory[int(k)] = tuple(v) 
+                table.page_directory = directory
+            else:
+                table.load_directory()
+            table.load_zones()
     
             # restore the indexes so we know which page range is the current one
             if 'cur_base_range_index' in table_data:
@@ -67,11 +245,128 @@ class Database():
             if table.cur_base_range_index < 0:
                 table.new_base_page_range()
 
+            if 'indexes' in table_data:#bring back the indexes made with create_index (and drop the dropped ones)
+                table.index.indices = [OOBTree() if col in table_data['indexes'] else None for col in range(num_columns)]
+            if 'hash_indexes' in table_data:
+                table.index.hashes = [{} if col in table_data['hash_indexes'] else None for col in range(num_columns)]
+            for col in table_data.get('bitmap_indexes', []):
+                table.index.bitmaps[col] = {}
+            saved_indexes[name] = (table.index.indexed_columns(), table_data.get('index_lsn'))
             table.index.needs_rebuild = True#marks index as need to rebuild
             self.tables.append(table)#append the table to tables
 
+        replayed = set()
+        if self.wal is not None:
+            replayed = self.recover()
+
+        for table in self.tables:
+            # the index files match the pages only if they were saved by the checkpoint the tables were loaded from and
+            # the log had nothing more for the table, anything else is rebuilt from the pages on first use
+            columns, index_lsn = saved_indexes.get(table.name, (None, None))
+            if index_lsn is not None and index_lsn == meta.get('checkpoint_lsn') and table.name not in replayed:
+                table.index.load(table.directory_path(), columns)
+
+        if checkpoint_interval is not None:
+            self.checkpoint_stop.clear()
+            self.checkpointer = threading.Thread(target = self.checkpoint_loop, args = (checkpoint_interval, checkpoint_log_bytes), daemon = True)
+            self.checkpointer.start()
+
+        if prewarm:
+            self.bufferpool.prewarm(sequential = prewarm_sequential)
+
             
 
+    # hooks a table up to the database's log, operation lock and checkpoints
+    def attach(self, table):
+        table.wal = self.wal
+        table.op_lock = self.op_lock
+        if table.directory_changes is None:
+            table.directory_changes = {}
+
+    # redo recovery: everything logged since the last checkpoint is replayed on top of its metadata.json, directory files
+    # and pages, returns the names of the tables the log changed
+    def recover(self):
+        # lsns have to stay above every lsn already stamped on a page even if the log file was lost
+        flushed = [lsn for size, lsn in self.bufferpool.disk_manager.keys.entries().values()]
+        self.wal.next_lsn = max([self.wal.next_lsn] + [lsn + 1 for lsn in flushed])
+        replayed = set()
+        for lsn, record in self.wal.replay():
+            replayed.add(record[1])
+            if record[0] == 'create':
+                name, num_columns, key_index = record[1:]
+                self.tables = [table for table in self.tables if table.name != name]
+                table = Table(name, num_columns, key_index, loading=True, db_path=self.path, bufferpool=self.bufferpool)
+                self.attach(table)
+                self.tables.append(table)
+            elif record[0] == 'drop':
+                self.tables = [table for table in self.tables if table.name != record[1]]
+            else:
+                table = self.get_table(record[1])
+                if table is not None:
+                    table.redo(lsn, record)
+        for table in self.tables:
+            table.index.needs_rebuild = True#index contents aren't logged, they are rebuilt from the recovered pages
+        return replayed
+
+    # incremental fuzzy checkpoint: writes only the pages dirtied and directory entries changed since the last one, then
+    # lets the log drop everything before it. Queries keep running, they are only held off while the snapshot is taken
+    # save_indexes also writes out the contents of every index (close does), otherwise only which columns are indexed
+    def checkpoint(self, save_indexes = False):
+        if self.bufferpool is None:
+            return
+        with self.checkpoint_lock:
+            # this will hold all the info we need to save for every table
+            meta = {'tables': [], 'storage': self.bufferpool.storage, 'page_format': PAGE_FORMAT_VERSION}
+            directories = []
+            self.bufferpool.wait_for_writes() # so the snapshot below rarely has to wait on flusher I/O with queries held off
+            with self.op_lock.exclusive(): # no operation is half done while the checkpoint lsn and the snapshot are taken
+                checkpoint_lsn = self.wal.next_lsn - 1 if self.wal is not None else 0
+                for table in self.tables:
+                    # save everything to rebuild the table later in open function (the page directory goes to directory.bin)
+                    meta['tables'].append({
+                        'name': table.name,
+                        'num_columns': table.num_columns,
+                        'key': table.key,
+                        'rid': table.rid,  # save rid so we dont reuse old rids
+                        'cur_base_range_index': table.cur_base_range_index,
+                        'cur_tail_range_index': table.cur_tail_range_index,
+                        'indexes': table.index.indexed_columns('btree'),
+                        'hash_indexes': table.index.indexed_columns('hash'),
+                        'bitmap_indexes': table.index.indexed_columns('bitmap'),
+                    })
+                    if save_indexes and not table.index.needs_rebuild:#an index that was never rebuilt is left to the next open
+                        table.index.save(table.directory_path())
+                        meta['tables'][-1]['index_lsn'] = checkpoint_lsn
+                    directories.append((table, table.take_directory_changes(), table.take_zones()))
+                meta['checkpoint_lsn'] = checkpoint_lsn
+                # dirty pages are only copied here, num_records goes with them in each page header
+                pages = self.bufferpool.checkpoint_snapshots()
+
+            self.bufferpool.write_snapshots(pages) # queries run again while the copies are written
+            for table, (full, entries), zones in directories:
+                table.save_directory(full, entries)
+                table.save_zones(zones)
+            if self.wal is not None:
+                self.bufferpool.disk_manager.sync()#the log is cut below so the pages have to really be on disk first
+
+            # write metadata to a file so we can load it back later in open
+            write_metadata(self.path, meta)
+
+            # every change up to the checkpoint lsn is now in the pages, directory files and metadata
+            if self.wal is not None:
+                self.wal.truncate(checkpoint_lsn)
+
+    def checkpoint_loop(self, interval, log_bytes):
+        last = time.monotonic()
+        while not self.checkpoint_stop.wait(min(interval, 1.0)):
+            if time.monotonic() - last < interval and (self.wal is None or self.wal.size < log_bytes):
+                continue
+            try:
+                self.checkpoint()
+            except Exception:
+                pass # the log still has everything, the next checkpoint tries again
+            last = time.monotonic()
+
     def close(self): #naomi
         # if no path is set, nothing to save
         if not self.path:
@@ -79,45 +374,20 @@ class Database():
         # if bufferpool was never created, nothing to save
         if self.bufferpool is None:
             return
-        # this will hold all the info we need to save for every table
-        meta = {'tables': []}
+        if self.checkpointer is not None:
+            self.checkpoint_stop.set()
+            self.checkpointer.join()
+            self.checkpointer = None
 
-        for table in self.tables:
-            # all dirty pages get writen to disk
-            table.bufferpool.flush_all()
-
-            # save num_records for every page for when you reload the pages from disk in open
-            base_num_records = self.save_num_records(table, 'base')
-            tail_num_records = self.save_num_records(table, 'tail')
-
-            # save everything to rebuild the table later in open function
-            table_data = {
-                'name': table.name,
-                'num_columns': table.num_columns,
-                'key': table.key,
-                'rid': table.rid,  # save rid so we dont reuse old rids
-                'cur_base_range_index': table.cur_base_range_index,
-                'cur_tail_range_index': table.cur_tail_range_index,
-                'base_num_records': base_num_records,
-                'tail_num_records': tail_num_records,
-            }
-            
-            # convert page directory keys to strings because json requires string keys
-            directory = {}
-            for k, v in table.page_directory.items():
-                directory[str(k)] = list(v)
-            table_data['page_directory'] = directory
-
-            meta['tables'].append(table_data)
- 
-        # write metadata to a file so we can load it back later in open
-        meta_path = self.path + '/metadata.json'
-        meta_file = io.open(meta_path, 'w')
-        json.dump(meta, meta_file) # converts Python data structures into the standardized JSON format
-        meta_file.close()    
+        # a last checkpoint, it only has the changes since the previous one to write, plus the indexes
+        self.checkpoint(save_indexes = True)
+
+        # release open segment files once everything is on disk
+        self.bufferpool.close()
+        if self.wal is not None:
+            self.wal.close()
+            self.wal = None
 
-    
-        
     """
     # Creates a new table
     :param name: string         #Table name
@@ -132,11 +402,15 @@ class Database():
             os.makedirs(self.path, exist_ok=True)
             self.bufferpool = BufferPool(capacity=100, path=self.path)#make bufferpool becasue it didnt exist before
         #bufferpool now for sure exists 
-        self.tables = [table for table in self.tables if table.name != name]#set tables to each table in tables not named the name spesified: holy  what a sentence 
-        table = Table(name, num_columns, key_index, loading=True, db_path=self.path)#make a table with all data 
-        table.bufferpool = self.bufferpool#set the tables bufferpool to the known bufferpool 
-        table.new_base_page_range()#allocate new base range
-        self.tables.append(table)#append table 
+        with self.op_lock:
+            self.tables = [table for table in self.tables if table.name != name]#set tables to each table in tables not named the name spesified: holy  what a sentence 
+            if self.wal is not None:
+                self.wal.append(('create', name, num_columns, key_index))
+            table = Table(name, num_columns, key_index, loading=True, db_path=self.path, bufferpool=self.bufferpool)#make a table with all data that uses the known bufferpool
+            self.attach(table)
+            table.new_base_page_range()#allocate new base range
+            self.tables.append(table)#append table 
+        table.commit()
         return table
     
     """
@@ -146,7 +420,11 @@ class Database():
         # loop through tables and remove the one with the matching name
         for table in self.tables:
             if table.name == name:
-                self.tables.remove(table)
+                with self.op_lock:
+                    if self.wal is not None:
+                        self.wal.append(('drop', name))
+                    self.tables.remove(table)
+                table.commit()
                 return
 
     
@@ -159,34 +437,3 @@ class Database():
             if table.name == name:
                 return table
         return None
-
-
-
-    def save_num_records(self, table, page_type):
-        num_records_list = []#will hold num_records for every range and column
-    
-        #figure out how many ranges exist for this page type
-        if page_type == 'base':
-            num_ranges = table.cur_base_range_index + 1#index starts at 0
-        else:
-            num_ranges = table.cur_tail_range_index + 1
-    
-        for range_index in range(num_ranges):
-            range_num_records = []#num_records for each column in this range
-    
-            for col in range(table.total_columns):
-                #grab the page from the bufferpool
-                page = table.bufferpool.get_page(table.name, page_type, range_index, col)
-    
-                if page is not None:
-                    #write the page to disk using the disk manager
-                    table.bufferpool.disk_manager.write_page(
-                        table.name, page_type, range_index, col, page
-                    )
-                    range_num_records.append(page.num_records)#save how full this page was
-                else:
-                    range_num_records.append(0)#page didn't exist, record 0
-    
-            num_records_list.append(range_num_records)
-    
-        return num_records_list
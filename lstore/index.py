@@ -1,8 +1,99 @@
 from BTrees.OOBTree import OOBTree #Import that allows us to use the btree
+from lstore.Config import RECORD_SIZE
+from concurrent.futures import ThreadPoolExecutor
+from itertools import accumulate, chain
+from functools import reduce
+from operator import and_
+from bisect import bisect_left
+from array import array
+import os
+import io
+import sys
+import struct
 """
 A data strucutre holding indices for various columns of a table. Key column should be indexd by default, other columns can be indexed through this object. Indices are usually B-Trees, but other data structures can be used as well.
+A column can have a B-tree (value -> [rids], serves locate and locate_range), a hash index (dict value -> rid, or [rids]
+once a value has more than one, serves locate only), a bitmap index (dict value -> Bitmap of rids, for columns with few
+distinct values, lets locate_all intersect predicates without touching records) or any mix of them. The key column has
+a B-tree and a hash index by default
 """
 
+INDIRECTION_COLUMN = 0 # same as in table.py, which imports this module
+RID_COLUMN = 1
+INDEX_KINDS = ('btree', 'hash', 'bitmap')
+CHUNK_BITS = 16 # a Bitmap keeps one int of 2^16 bits per block of rids that has any rid in it
+INDEX_HEADER = struct.Struct('<8sqq') # index_<col>.bin header: magic, number of keys, number of rids
+INDEX_MAGIC = b'LSTORIDX'
+# after the header come three little-endian int64 runs: the keys in order, how many rids each key has, and the rids
+
+
+class Bitmap: # set of rids as chunked bitsets: rid >> CHUNK_BITS -> int with bit (rid & mask) set, empty chunks are left out
+    # &, | and count work a whole chunk at a time on ints, iterating gives the rids in increasing order
+    def __init__(self, chunks = None):
+        self.chunks = chunks if chunks is not None else {}
+
+    @classmethod
+    def from_rids(cls, rids):
+        # Builds the chunks from a list of rids in one pass, setting bits in a bytearray per chunk instead of an int per rid
+        buffers = {}
+        for rid in rids:
+            buffer = buffers.get(rid >> CHUNK_BITS)
+            if buffer is None:
+                buffer = buffers[rid >> CHUNK_BITS] = bytearray(1 << (CHUNK_BITS - 3))
+            bit = rid & ((1 << CHUNK_BITS) - 1)
+            buffer[bit >> 3] |= 1 << (bit & 7)
+        return cls({chunk: int.from_bytes(buffer, 'little') for chunk, buffer in buffers.items()})
+
+    def add(self, rid):
+        chunk = rid >> CHUNK_BITS
+        self.chunks[chunk] = self.chunks.get(chunk, 0) | (1 << (rid & ((1 << CHUNK_BITS) - 1)))
+
+    def discard(self, rid):
+        chunk = rid >> CHUNK_BITS
+        bits = self.chunks.get(chunk, 0) & ~(1 << (rid & ((1 << CHUNK_BITS) - 1)))
+        if bits:
+            self.chunks[chunk] = bits
+        else:
+            self.chunks.pop(chunk, None)
+
+    def __contains__(self, rid):
+        return (self.chunks.get(rid >> CHUNK_BITS, 0) >> (rid & ((1 << CHUNK_BITS) - 1))) & 1 == 1
+
+    def __and__(self, other):
+        if len(other.chunks) < len(self.chunks):
+            self, other = other, self
+        chunks = {}
+        for chunk, bits in self.chunks.items():
+            both = bits & other.chunks.get(chunk, 0)
+            if both:
+                chunks[chunk] = both
+        return Bitmap(chunks)
+
+    def __or__(self, other):
+        chunks = dict(self.chunks)
+        for chunk, bits in other.chunks.items():
+            chunks[chunk] = chunks.get(chunk, 0) | bits
+        return Bitmap(chunks)
+
+    def count(self):
+        return sum(bits.bit_count() for bits in self.chunks.values())
+
+    def __len__(self):
+        return self.count()
+
+    def __bool__(self):
+        return bool(self.chunks)
+
+    def __iter__(self):
+        for chunk in sorted(self.chunks):
+            bits = self.chunks[chunk]
+            base = chunk << CHUNK_BITS
+            while bits:
+                lowest = bits & -bits
+                yield base + lowest.bit_length() - 1
+                bits ^= lowest
+
+
 class Index:
 
     def __init__(self, table):
@@ -11,10 +102,30 @@ class Index:
         #Alvin: This makes primary key column into a Btree for indexing
         self.table = table
         self.indices[table.key] = OOBTree()
+        self.hashes = [None] * table.num_columns # hash index of each column, point lookups on the key skip the btree
+        self.hashes[table.key] = {}
+        self.bitmaps = [None] * table.num_columns # bitmap index of each column, value -> Bitmap of base rids
         self.needs_rebuild = False  # Flag for lazy index rebuilding
+        self.build_workers = None # threads that read page ranges while an index is built, None reads them in the calling thread
 
     #Alvin: adding an insert function for the b-tree that appends values instead of replaces, this way keys (column values) can refer to multiple values (multiple RIDS)
+    #also adds the rid to the column's hash and bitmap index if it has them
     def insert_btree(self, column, key, value):
+        bitmaps = self.bitmaps[column]
+        if bitmaps is not None:
+            bitmap = bitmaps.get(key)
+            if bitmap is None:
+                bitmap = bitmaps[key] = Bitmap()
+            bitmap.add(value)
+        hashed = self.hashes[column]
+        if hashed is not None:
+            entry = hashed.get(key)
+            if entry is None:#unique values keep a bare rid, no list per key
+                hashed[key] = value
+            elif type(entry) is list:
+                entry.append(value)
+            else:
+                hashed[key] = [entry, value]
         if self.indices[column] is None:
             return 
         btree = self.indices[column]
@@ -23,8 +134,40 @@ class Index:
         else:
             btree[key] = [value]
 
+    def insert_many(self, column, pairs):#adds (value, rid) pairs to every index of column, an empty column is bulk built from them
+        pairs = sorted(pairs)
+        if self.is_empty(column):
+            grouped = []
+            for value, rid in pairs:
+                if grouped and grouped[-1][0] == value:
+                    grouped[-1][1].append(rid)
+                else:
+                    grouped.append((value, [rid]))
+            self.install(column, grouped)
+            return
+        for value, rid in pairs:#in key order so the btree fills neighbouring buckets
+            self.insert_btree(column, value, rid)
+
+    def is_empty(self, column):#True if none of the indexes of column has an entry
+        return not self.indices[column] and not self.hashes[column] and not self.bitmaps[column]
+
     #Alvin: NEW Function for deleting RID in a column (usually for removal of outdated recors)
     def delete_rid(self, column, valueInCol, RIDtoDelete):
+        bitmaps = self.bitmaps[column]
+        if bitmaps is not None:
+            bitmap = bitmaps[valueInCol]
+            bitmap.discard(RIDtoDelete)
+            if not bitmap:
+                del bitmaps[valueInCol]
+        hashed = self.hashes[column]
+        if hashed is not None:
+            entry = hashed[valueInCol]
+            if type(entry) is list:
+                entry.remove(RIDtoDelete)
+                if len(entry) == 1:
+                    hashed[valueInCol] = entry[0]
+            elif entry == RIDtoDelete:
+                del hashed[valueInCol]
         if self.indices[column] is not None:
             colIndex = self.indices[column]
             RIDOutput = colIndex[valueInCol]
@@ -40,17 +183,16 @@ class Index:
     def locate(self, column, value):# Sage: bug fixes from VS code 
         if self.needs_rebuild:#Sage: fix for optimization 
             self.rebuild_indices()# calls the rebuild function 
+        hashed = self.hashes[column]
+        if hashed is not None:#one dict lookup instead of walking the btree
+            entry = hashed.get(value)
+            if entry is None:
+                return []
+            return entry if type(entry) is list else [entry]
+        if self.indices[column] is None and self.bitmaps[column] is not None:
+            return list(self.bitmaps[column].get(value, ()))
         if self.indices[column] is None:#Sage: optimized and cleaned to implement MS extended cases added checking if the index was not defined
-            matching_rids = []#initialize matching rids 
-            for base_rid, location in self.table.page_directory.items():#grab base rid and location ie offset from page directory 
-                page_type, range_index, offset = location# grab page type range index and offset from location/ offset
-                if page_type != 'base':#skip tail pages as they do not need locating 
-                    continue
-                # Read the specific column value
-                col_value = self.table.get_page('base', range_index, 4 + column).read(offset)#grab the column value from base pages and get function
-                if col_value == value:
-                    matching_rids.append(base_rid)#append the rid to matching rids if the valyes match 
-            return matching_rids#return the matching rids list
+            return self.scan(column, value, value)#no index: scan the base pages whose zone can hold the value
         if value in self.indices[column]:#check value in column
             return self.indices[column][value]  
         else:
@@ -63,66 +205,277 @@ class Index:
     def locate_range(self, begin, end, column):
         if self.needs_rebuild:#Sage: efficency rebuild if needed
             self.rebuild_indices()
+        if self.indices[column] is None and self.bitmaps[column] is not None:#or the bitmaps of every value in the range
+            bitmaps = self.bitmaps[column]
+            return list(reduce(Bitmap.__or__, [bitmaps[value] for value in bitmaps if begin <= value <= end], Bitmap()))
         if self.indices[column] is None: # sage: check none case to avoid potential errors that did happen
-            matching_rids = []
-            for base_rid, location in self.table.page_directory.items():
-                page_type, range_index, offset = location
-                if page_type != 'base':#skips tail records for speeeed
-                    continue
-                # Read the specific column value
-                col_value = self.table.get_page('base', range_index, 4 + column).read(offset)
-                if begin <= col_value <= end:#append the range if it is between begining and end
-                    matching_rids.append(base_rid)
-            return matching_rids
-        valueExists = list(self.indices[column].keys(min=begin, max=end))
-        RIDList = []
-        #removes the lists format so only RID values are inputed into the list
-        for value in valueExists:
-            RIDList.extend(self.indices[column][value])#add all retrived values to ValidRIDs
+            return self.scan(column, begin, end)
+        #removes the lists format so only RID values are inputed into the list, in one pass over the btree's values
+        RIDList = list(chain.from_iterable(self.indices[column].values(min=begin, max=end)))
         return RIDList
+
+    def scan(self, column, begin, end):#base rids whose base value in column is between begin and end, read from the pages
+        #ranges whose zone (min/max of the page, see Table.zone) misses [begin, end] are skipped without reading a slot
+        ranges = [range_index for range_index in range(self.table.cur_base_range_index + 1)
+                  if self.table.zone(range_index, column)[0] <= end and self.table.zone(range_index, column)[1] >= begin]
+        if ranges:
+            self.table.read_ahead('base', [RID_COLUMN, 4 + column], ranges[0])#let the bufferpool load ranges ahead
+        matching_rids = []
+        for range_index in ranges:
+            page = self.table.get_page('base', range_index, 4 + column)
+            values = page.read_all()[:page.num_records]#decode the whole column page in one call
+            rids = self.table.get_page('base', range_index, RID_COLUMN).read_all()
+            for slot, col_value in enumerate(values):
+                if begin <= col_value <= end:
+                    rid = rids[slot]
+                    if self.table.page_directory.get(rid) == ('base', range_index, slot * RECORD_SIZE):#skip deleted records
+                        matching_rids.append(rid)
+        return matching_rids
+
+    def locate_many(self, column, values):#{value: [rids]} for every value, in one pass over the index (or the pages)
+        if self.needs_rebuild:
+            self.rebuild_indices()
+        if self.is_indexed(column):
+            return {value: self.locate(column, value) for value in sorted(set(values))}#sorted so btree lookups walk neighbouring buckets
+        wanted = sorted(set(values))
+        found = {value: [] for value in wanted}
+        if not wanted:
+            return found
+        ranges = []
+        for range_index in range(self.table.cur_base_range_index + 1):#keep the ranges whose zone holds at least one value
+            low, high = self.table.zone(range_index, column)
+            position = bisect_left(wanted, low)
+            if position < len(wanted) and wanted[position] <= high:
+                ranges.append(range_index)
+        if ranges:
+            self.table.read_ahead('base', [RID_COLUMN, 4 + column], ranges[0])
+        for range_index in ranges:
+            page = self.table.get_page('base', range_index, 4 + column)
+            values = page.read_all()[:page.num_records]
+            rids = self.table.get_page('base', range_index, RID_COLUMN).read_all()
+            for slot, col_value in enumerate(values):
+                if col_value in found:
+                    rid = rids[slot]
+                    if self.table.page_directory.get(rid) == ('base', range_index, slot * RECORD_SIZE):
+                        found[col_value].append(rid)
+        return found
+
+    def bitmap_of(self, column, value):#Bitmap of the base rids whose column equals value, from the bitmap index or from locate
+        if self.needs_rebuild:
+            self.rebuild_indices()
+        if self.bitmaps[column] is not None:
+            return self.bitmaps[column].get(value, Bitmap())
+        return Bitmap.from_rids(self.locate(column, value))
+
+    def match_all(self, predicates):#Bitmap of the base rids matching every {column: value} in predicates
+        # bitmaps are intersected smallest first so every later and only looks at chunks still left
+        bitmaps = sorted([self.bitmap_of(column, value) for column, value in predicates.items()], key = len)
+        return reduce(and_, bitmaps) if bitmaps else Bitmap()
+
+    #base rids of the records matching every predicate, in rid order
+    #locate_all({2: 90, 3: 85}) -> records whose column 2 is 90 and column 3 is 85
+    def locate_all(self, predicates):
+        return list(self.match_all(predicates))
+
+    def count_all(self, predicates):#how many records match every predicate, without listing them
+        return self.match_all(predicates).count()
     def rebuild_indices(self):#Sage
         #Rebuild all indices from page_directory (called lazily on first query)
         if not self.needs_rebuild:#edge case check
             return
         
-        for base_rid, location in self.table.page_directory.items():#grab location and base rid
-            page_type, range_index, offset = location#set the other three 
-            if page_type != 'base':#skip tail pages 
-                continue
-            # Read only indexed columns from base pages
-            for col in range(self.table.num_columns):
-                if self.indices[col] is not None:
-                    value = self.table.get_page('base', range_index, 4 + col).read(offset)#do a rebuild
-                    self.insert_btree(col, value, base_rid)
+        for col, grouped in self.build(self.indexed_columns()).items():
+            self.install(col, grouped)#swap in the freshly built indexes
         
         self.needs_rebuild = False#se tthe rebuild to fale as it has been rebuilt
 
+    def build(self, columns, workers = None):#bulk reads the index contents of columns from the pages, returns {column: [(value, [rids])]} in value order
+        #reads whole column pages range by range instead of one record at a time, then sorts (value, rid) so trees can
+        #be loaded in key order. workers threads read ranges in parallel (defaults to build_workers)
+        if workers is None:
+            workers = self.build_workers
+        ranges = {}#base range index -> [(base rid, slot)] of every live record in that range
+        for base_rid, location in self.table.page_directory.items():
+            page_type, range_index, offset = location
+            if page_type == 'base':
+                ranges.setdefault(range_index, []).append((base_rid, offset // RECORD_SIZE))
+        self.table.read_ahead('base', [INDIRECTION_COLUMN] + [4 + col for col in columns])
+        if workers:
+            with ThreadPoolExecutor(max_workers = workers) as pool:
+                extracted = list(pool.map(lambda item: self.extract_range(item[0], item[1], columns), ranges.items()))
+        else:
+            extracted = [self.extract_range(range_index, records, columns) for range_index, records in ranges.items()]
+        trees = {}
+        for position, col in enumerate(columns):
+            pairs = [pair for range_pairs in extracted for pair in range_pairs[position]]
+            pairs.sort()
+            grouped = []#(value, [rids]) in value order
+            for value, rid in pairs:
+                if grouped and grouped[-1][0] == value:
+                    grouped[-1][1].append(rid)
+                else:
+                    grouped.append((value, [rid]))
+            trees[col] = grouped
+        return trees
+
+    def install(self, column, grouped):#replaces every index column has with one holding grouped, (value, [rids]) in value order
+        if self.indices[column] is not None:
+            btree = self.indices[column] = OOBTree()
+            btree.update(grouped)#sorted input fills the buckets in order
+        if self.hashes[column] is not None:
+            self.hashes[column] = {value: rids[0] if len(rids) == 1 else list(rids) for value, rids in grouped}
+        if self.bitmaps[column] is not None:
+            self.bitmaps[column] = {value: Bitmap.from_rids(rids) for value, rids in grouped}
+
+    def entries(self, column):#(value, [rids]) of column in value order, from whichever index it has
+        if self.indices[column] is not None:
+            return list(self.indices[column].items())
+        if self.bitmaps[column] is not None:
+            return [(value, list(self.bitmaps[column][value])) for value in sorted(self.bitmaps[column])]
+        return [(value, entry if type(entry) is list else [entry]) for value, entry in sorted(self.hashes[column].items())]
+
+    def group_counts(self, column, rids = None):#(value, number of records) of column in value order, only counting rids when given
+        if self.bitmaps[column] is not None:#bitmaps are counted (and intersected) a chunk at a time without listing rids
+            bitmaps = self.bitmaps[column]
+            if rids is None:
+                return [(value, bitmaps[value].count()) for value in sorted(bitmaps)]
+            wanted = Bitmap.from_rids(rids)
+            return [(value, (bitmaps[value] & wanted).count()) for value in sorted(bitmaps)]
+        if rids is None:
+            return [(value, len(entry)) for value, entry in self.entries(column)]
+        wanted = set(rids)
+        return [(value, sum(1 for rid in entry if rid in wanted)) for value, entry in self.entries(column)]
+
+    def extract_range(self, range_index, records, columns):#(value, base rid) pairs of one base range for each column, latest versions
+        base_values = [self.table.get_page('base', range_index, 4 + col).read_all() for col in columns]
+        indirections = self.table.get_page('base', range_index, INDIRECTION_COLUMN).read_all()
+        tail_values = {}#tail range index -> decoded pages of the columns, each tail page is read once for the whole range
+        pairs = [[] for col in columns]
+        for base_rid, slot in records:
+            values = base_values
+            indirection = indirections[slot]
+            if indirection != 0:
+                tail = self.table.page_directory.get(indirection)
+                if tail is not None:
+                    #the newest tail record holds every column as of its update, so it alone gives the latest values
+                    tail_type, tail_range_index, tail_offset = tail
+                    values = tail_values.get(tail_range_index)
+                    if values is None:
+                        values = tail_values[tail_range_index] = [self.table.get_page('tail', tail_range_index, 4 + col).read_all() for col in columns]
+                    slot_values = [column_values[tail_offset // RECORD_SIZE] for column_values in values]
+                    for position in range(len(columns)):
+                        pairs[position].append((slot_values[position], base_rid))
+                    continue
+            for position in range(len(columns)):
+                pairs[position].append((values[position][slot], base_rid))
+        return pairs
+
     """
     # optional: Create index on specific column
     """
     #Updated again on 2/21/26 to be able to handle cases where we removed outdated RID records, so we don't reenter then into index 
     #Alvin: Redone for M2 to allow making the index AFTER already having records inserted, will go through every RID
     # (base and tail) and add its column value into the newly created btree
-    def create_index(self, column_number):
+    #bulk built from the column pages (see build), every base rid goes in under its latest value
+    #kind is 'btree', 'hash' or 'bitmap', indexes of other kinds the column already has are kept alongside
+    #the new index is logged so it comes back after a crash (recovery rebuilds its contents from the pages)
+    def create_index(self, column_number, workers = None, kind = 'btree'):
+        if kind not in INDEX_KINDS:
+            raise ValueError("Unknown index kind: " + str(kind))
         if self.needs_rebuild:
             self.rebuild_indices()
-        #creates the bTree for that column
-        self.indices[column_number] = OOBTree()
-        #Index/btree can be created at any point in time for non-primary key columns, so if creating index later, must get all values from before
-        #Concept: for all current RID entries, access that specific column number and retrieve + index it to the B-tree
-        flatList = [RID for sublist in list(self.indices[self.table.key].values()) for RID in sublist]
-        for rid in flatList:
-            if rid in self.table.page_directory: #checks to make sure rid is in the page directory
-                current_record = self.table.get_record(rid)
-                keyForTree = current_record.columns[column_number]
-                self.table.index.insert_btree(column_number, keyForTree, rid)
+        with self.table.operation():#a checkpoint sees the index either not there or complete
+            self.table.log(('index', self.table.name, column_number, kind))
+            #Index/btree can be created at any point in time for non-primary key columns, so if creating index later, must get all values from before
+            self.define(column_number, kind)
+            self.install(column_number, self.build([column_number], workers)[column_number])
         return True
 
+    def define(self, column_number, kind):#puts an empty index of kind on the column, build/rebuild_indices fill it
+        if kind == 'btree':
+            self.indices[column_number] = OOBTree()
+        elif kind == 'hash':
+            self.hashes[column_number] = {}
+        else:
+            self.bitmaps[column_number] = {}
+
     """
     # optional: Drop index of specific column
     """
 
-    def drop_index(self, column_number):
-        #reset that index back to none
-        self.indices[column_number] = None
+    def drop_index(self, column_number, kind = None, logged = True):
+        #reset that index back to none, kind drops only the 'btree', 'hash' or 'bitmap' index
+        if logged:
+            with self.table.operation():
+                self.table.log(('drop_index', self.table.name, column_number, kind))
+                return self.drop_index(column_number, kind, logged = False)
+        if kind in (None, 'btree'):
+            self.indices[column_number] = None
+        if kind in (None, 'hash'):
+            self.hashes[column_number] = None
+        if kind in (None, 'bitmap'):
+            self.bitmaps[column_number] = None
+        return True
+
+    def is_indexed(self, column):
+        return self.indices[column] is not None or self.hashes[column] is not None or self.bitmaps[column] is not None
+
+    def indexed_columns(self, kind = None):#columns that have an index (of that kind), saved with the table so they come back on open
+        kinds = {None: (self.indices, self.hashes, self.bitmaps), 'btree': (self.indices,), 'hash': (self.hashes,), 'bitmap': (self.bitmaps,)}[kind]
+        return [col for col in range(self.table.num_columns) if any(structures[col] is not None for structures in kinds)]
+
+    def save(self, path):#writes every index as sorted runs to path/index_<col>.bin, files of dropped indexes are removed
+        os.makedirs(path, exist_ok=True)
+        for col in range(self.table.num_columns):
+            index_path = path + "/index_" + str(col) + ".bin"
+            if not self.is_indexed(col):
+                if os.path.exists(index_path):
+                    os.remove(index_path)
+                continue
+            grouped = self.entries(col)
+            keys = array('q', [value for value, rid_list in grouped])
+            rid_lists = [rid_list for value, rid_list in grouped]
+            counts = array('q', map(len, rid_lists))
+            rids = array('q', [rid for rid_list in rid_lists for rid in rid_list])
+            if sys.byteorder != 'little':
+                for run in (keys, counts, rids):
+                    run.byteswap()
+            index_file = io.open(index_path + ".tmp", 'wb')
+            index_file.write(INDEX_HEADER.pack(INDEX_MAGIC, len(keys), len(rids)))
+            for run in (keys, counts, rids):
+                index_file.write(run.tobytes())
+            index_file.flush()
+            os.fsync(index_file.fileno())
+            index_file.close()
+            os.replace(index_path + ".tmp", index_path)
+
+    def load(self, path, columns):#bulk loads the indexes saved by save into the indexes set up on those columns, returns False (and loads nothing) if any file is missing
+        loaded = {}
+        for col in columns:
+            index_path = path + "/index_" + str(col) + ".bin"
+            if not os.path.exists(index_path):
+                return False
+            index_file = io.open(index_path, 'rb')
+            data = index_file.read()
+            index_file.close()
+            magic, key_count, rid_count = INDEX_HEADER.unpack_from(data, 0)
+            if magic != INDEX_MAGIC or len(data) != INDEX_HEADER.size + 8 * (2 * key_count + rid_count):
+                return False
+            runs = []
+            position = INDEX_HEADER.size
+            for size in (key_count, key_count, rid_count):
+                run = array('q')
+                run.frombytes(data[position:position + 8 * size])
+                if sys.byteorder != 'little':
+                    run.byteswap()
+                runs.append(run)
+                position += 8 * size
+            keys, counts, rids = runs
+            rids = rids.tolist()
+            ends = list(accumulate(counts))
+            starts = [0] + ends[:-1]
+            loaded[col] = list(zip(keys, [rids[start:end] for start, end in zip(starts, ends)]))
+        for col, grouped in loaded.items():
+            self.install(col, grouped)
+        self.needs_rebuild = False
         return True
@@ -1,18 +1,57 @@
-from lstore.Config import PAGE_SIZE, RECORD_SIZE
+from lstore.Config import PAGE_SIZE, RECORD_SIZE, PAGE_HEADER_SIZE, PAGE_FORMAT_VERSION
+from operator import itemgetter
+import struct
+
+# Slots are stored as native byte order signed 64-bit ints so a whole page can be viewed as an array('q') without copying
+SLOT = struct.Struct('=q')
+
+# Page header lives in the last PAGE_HEADER_SIZE bytes of the page: version (H), flags (H), num_records (I), lsn (q)
+# Keeping it inside the page means offsets don't move and the header travels with the data on every read/write/mmap
+HEADER_OFFSET = PAGE_SIZE - PAGE_HEADER_SIZE
+VERSION_FIELD = struct.Struct('=H')
+COUNT_FIELD = struct.Struct('=I')
+LSN_FIELD = struct.Struct('=q')
+COUNT_OFFSET = HEADER_OFFSET + 4
+LSN_OFFSET = HEADER_OFFSET + 8
+MAX_SLOTS = HEADER_OFFSET // RECORD_SIZE # 510 slots fit in front of the header
 
 class Page:
 
     def __init__(self, capacity = None): # Nicholas and Sage
-        self.num_records = 0
         # This is just a bytearray that is representative of pages raw data
         self.data = bytearray(PAGE_SIZE)
+        VERSION_FIELD.pack_into(self.data, HEADER_OFFSET, PAGE_FORMAT_VERSION)
+        self.num_records = 0
         # Calculates page capacity if capacity is not provided
         self.pin_count = 0 # Iris: number of users currently accessing the page (default is 0)
         # If pin_count > 0, then the page should be locked before merge happens
+        # Pins are taken and released by BufferPool.fetch/unpin (or pinned), eviction skips pinned pages
         if capacity is None:
-            self.capacity = PAGE_SIZE // RECORD_SIZE # 512 records for a 4kb page
+            self.capacity = MAX_SLOTS # 510 records for a 4kb page once the header is taken out
         else: 
-            self.capacity = capacity
+            self.capacity = min(capacity, MAX_SLOTS) # never let records run into the header
+
+    # num_records and lsn are read from and written to the header in self.data so whatever is on disk is always complete
+    @property
+    def num_records(self):
+        return COUNT_FIELD.unpack_from(self.data, COUNT_OFFSET)[0]
+
+    @num_records.setter
+    def num_records(self, value):
+        COUNT_FIELD.pack_into(self.data, COUNT_OFFSET, value)
+
+    @property
+    def lsn(self):
+        # log sequence number of the last change made to the page, 0 until something logs it
+        return LSN_FIELD.unpack_from(self.data, LSN_OFFSET)[0]
+
+    @lsn.setter
+    def lsn(self, value):
+        LSN_FIELD.pack_into(self.data, LSN_OFFSET, value)
+
+    def format_version(self):
+        # Page format the header was written with (0 means the page was never initialized)
+        return VERSION_FIELD.unpack_from(self.data, HEADER_OFFSET)[0]
 
     def has_capacity(self): # Nicholas
         # Return booloean value indicating if page is has capacity left for new records
@@ -20,7 +59,6 @@ class Page:
 
     
     def write(self, value): # Sage and Nicholas
-        self.pin_count += 1 # Iris: add 1 to pin_count when user is writing to the page
         # Writes a value to next available slot on the page and returns -1 if page is full
         if self.has_capacity():
             # Calculates offset like standard Lstore 
@@ -28,31 +66,53 @@ class Page:
             if value is None: 
                 value = 0
             # Stores data as a 64-bit integer from offset to end of record as bytes 
-            self.data[offset:offset + RECORD_SIZE] = value.to_bytes(RECORD_SIZE, byteorder='big', signed=True)
+            SLOT.pack_into(self.data, offset, value)
             self.num_records += 1 # Updates num_records to record the new number of total records
-            self.pin_count -= 1 # Iris: reduce pin_count by 1 once write is done
             return offset 
         else:
-            self.pin_count -= 1 # Iris: reduce pin_count by 1 when function terminates
             # Indicates that the page is full and a new page needs to be created
             return -1
             
     def read(self, offset): # Sage
         # Read a value from the page at the given offset.
         # Returns the integer value stored at that offset.
-        self.pin_count += 1 # Iris: add 1 to pin_count when a value is being updated
-        value_bytes = self.data[offset:offset + RECORD_SIZE] # Grabs the data from the offset to the end of the record 
-        value = int.from_bytes(value_bytes, byteorder = 'big', signed=True) # Changes value_bytes to ints and returns them 
-        self.pin_count -= 1 # Iris: once update is done, reduce pin_count by 1
+        value = SLOT.unpack_from(self.data, offset)[0] # Decodes the 64-bit int stored from the offset to the end of the record
         return value 
 
     def update(self, offset, value): # Sage
         # Updates a value at a specific offset in the page
-        self.pin_count += 1 # Iris: add 1 to pin_count when a value is being updated
         if value is None: 
             value = 0 
-        self.data[offset:offset + RECORD_SIZE] = value.to_bytes(RECORD_SIZE, byteorder='big', signed=True)
-        self.pin_count -= 1 # Iris: once update is done, reduce pin_count by 1
+        SLOT.pack_into(self.data, offset, value)
+
+    def update_many(self, offset, values):
+        # Overwrites consecutive slots starting at offset in one call, None is stored as 0 like update
+        struct.pack_into('=%dq' % len(values), self.data, offset, *[0 if value is None else value for value in values])
+
+    def read_all(self):
+        # Returns the whole page as one zero-copy int64 view over the page data (index with offset // RECORD_SIZE)
+        # Slots past num_records read as 0. The view shares memory with the page so later writes show up in it,
+        # call .tolist() or array('q', view) for a snapshot
+        return memoryview(self.data).cast('q')[:self.capacity]
+
+    def read_many(self, offsets):
+        # Reads the values at a list of byte offsets in one call, returns them as a list in the same order
+        if not offsets:
+            return []
+        view = memoryview(self.data).cast('q')
+        if len(offsets) == 1:
+            return [view[offsets[0] // RECORD_SIZE]]
+        return list(itemgetter(*[offset // RECORD_SIZE for offset in offsets])(view))
+
+    def write_many(self, values):
+        # Appends values into the next free slots in one call, None is stored as 0 like write
+        # Returns how many values were written which is less than len(values) once the page fills up
+        count = min(len(values), self.capacity - self.num_records)
+        if count <= 0:
+            return 0
+        struct.pack_into('=%dq' % count, self.data, self.num_records * RECORD_SIZE, *[0 if value is None else value for value in values[:count]])
+        self.num_records += count
+        return count
 
 
     def get_num_records(self): # Sage
@@ -0,0 +1,207 @@
+import os
+import io
+import sys
+import mmap
+import struct
+from array import array
+from lstore.Config import RECORD_SIZE
+
+"""
+On disk page directory of a table, written by checkpoints:
+  directory.bin  header, then one little-endian int64 location word per rid (rid n is the n-th word), mmapped on open
+  directory.log  header, then (rid, location word) pairs appended by every checkpoint since directory.bin was written
+Both headers carry a generation, a log whose generation doesn't match directory.bin is left over from before the last
+rewrite and is ignored. A location word packs ('base'|'tail', range index, offset) into one int, 0 means no record
+"""
+
+LOCATION_TYPES = (None, 'base', 'tail') # type code in the low 2 bits of a location word <-> page type
+OFFSET_BITS = 16 # offsets are byte offsets inside a 4kb page
+DIRECTORY_HEADER = struct.Struct('<8sqq') # directory.bin header: magic, number of rids, generation
+CHANGES_HEADER = struct.Struct('<8sq') # directory.log header: magic, generation of the directory.bin it applies to
+CHANGE_ENTRY = struct.Struct('<qq') # directory.log entry: rid, location word (0 = removed)
+DIRECTORY_MAGIC = b'LSTORDIR'
+CHANGES_MAGIC = b'LSTORDLG'
+
+
+def pack_location(location):
+    # ('base', 3, 816) -> location word, None -> 0
+    if location is None:
+        return 0
+    page_type, range_index, offset = location
+    return (range_index << (OFFSET_BITS + 2)) | (offset << 2) | LOCATION_TYPES.index(page_type)
+
+
+def unpack_location(word):
+    # location word -> ('base', 3, 816), 0 -> None
+    if word == 0:
+        return None
+    return (LOCATION_TYPES[word & 3], word >> (OFFSET_BITS + 2), (word >> 2) & ((1 << OFFSET_BITS) - 1))
+
+
+def read_directory(path):
+    # Returns (words, generation, changes) saved for a table: words is an int64 sequence indexed by rid (a view over
+    # the mmapped file, or an array on big-endian machines), changes is the list of (rid, word) to apply on top of it
+    # Returns (None, 0, []) if the table has no directory files yet
+    words = None
+    generation = 0
+    if os.path.exists(path + "/directory.bin"):
+        directory_file = io.open(path + "/directory.bin", 'rb')
+        magic, count, generation = DIRECTORY_HEADER.unpack(directory_file.read(DIRECTORY_HEADER.size))
+        if magic != DIRECTORY_MAGIC:
+            directory_file.close()
+            raise Exception("Page directory at " + path + " is not readable")
+        if count == 0:
+            words = array('q')
+        elif sys.byteorder == 'little':
+            # the file stays mapped for as long as the view is alive, nothing is read until a word is used
+            mapping = mmap.mmap(directory_file.fileno(), 0, access = mmap.ACCESS_READ)
+            words = memoryview(mapping)[DIRECTORY_HEADER.size:DIRECTORY_HEADER.size + count * 8].cast('q')
+        else:
+            words = array('q')
+            words.frombytes(directory_file.read(count * 8))
+            words.byteswap()
+        directory_file.close()
+    changes = []
+    if os.path.exists(path + "/directory.log"):
+        changes_file = io.open(path + "/directory.log", 'rb')
+        log = changes_file.read()
+        changes_file.close()
+        if len(log) >= CHANGES_HEADER.size and CHANGES_HEADER.unpack_from(log, 0) == (CHANGES_MAGIC, generation):
+            log = log[CHANGES_HEADER.size:]
+            log = log[:len(log) - len(log) % CHANGE_ENTRY.size] # a torn entry at the end is dropped
+            changes = list(CHANGE_ENTRY.iter_unpack(log))
+    return words, generation, changes
+
+
+def write_directory(path, words, generation):
+    # Replaces directory.bin with a full snapshot (words indexed by rid), the old change log no longer applies
+    os.makedirs(path, exist_ok = True)
+    if sys.byteorder != 'little':
+        words = array('q', words)
+        words.byteswap()
+    directory_file = io.open(path + "/directory.bin.tmp", 'wb')
+    directory_file.write(DIRECTORY_HEADER.pack(DIRECTORY_MAGIC, len(words), generation))
+    directory_file.write(memoryview(words).cast('B'))
+    directory_file.flush()
+    os.fsync(directory_file.fileno())
+    directory_file.close()
+    os.replace(path + "/directory.bin.tmp", path + "/directory.bin")
+    if os.path.exists(path + "/directory.log"):
+        os.remove(path + "/directory.log")
+
+
+def append_changes(path, changes, generation):
+    # Appends (rid, word) pairs to directory.log, starting the log if this is the first change since the last snapshot
+    os.makedirs(path, exist_ok = True)
+    header = CHANGES_HEADER.pack(CHANGES_MAGIC, generation)
+    new = True
+    if os.path.exists(path + "/directory.log"):
+        changes_file = io.open(path + "/directory.log", 'rb')
+        new = changes_file.read(CHANGES_HEADER.size) != header # a log from before a rewrite that crashed before removing it
+        changes_file.close()
+    changes_file = io.open(path + "/directory.log", 'wb' if new else 'ab')
+    if new:
+        changes_file.write(header)
+    changes_file.write(b''.join([CHANGE_ENTRY.pack(rid, word) for rid, word in changes]))
+    changes_file.flush()
+    os.fsync(changes_file.fileno())
+    changes_file.close()
+
+
+class PageDirectory(): # rid -> ('base'|'tail', range index, offset) kept as one packed location word per rid
+    # Rids are handed out densely from Table.rid so an array indexed by rid wastes almost nothing, and every record
+    # costs 8 bytes instead of a dict entry plus a tuple. Works like the dict it replaces: in, [], get, del, pop, items
+    def __init__(self, words = None):
+        self.words = words if words is not None else array('q') # location word of every rid, 0 where there is no record
+        self.count = len(self.words) - self.words.count(0) # rids that have a location
+
+    @classmethod
+    def from_words(cls, words):
+        # Copies a sequence of words (e.g. the mmapped directory.bin) into a new directory in one go
+        copy = array('q')
+        copy.frombytes(memoryview(words).cast('B'))
+        return cls(copy)
+
+    def __contains__(self, rid):
+        return 0 <= rid < len(self.words) and self.words[rid] != 0
+
+    def __getitem__(self, rid):
+        word = self.words[rid] if 0 <= rid < len(self.words) else 0
+        if word == 0:
+            raise KeyError(rid)
+        return (LOCATION_TYPES[word & 3], word >> (OFFSET_BITS + 2), (word >> 2) & ((1 << OFFSET_BITS) - 1))
+
+    def get(self, rid, default = None):
+        if rid in self:
+            return self[rid]
+        return default
+
+    def __setitem__(self, rid, location):
+        if rid >= len(self.words):
+            # grow by at least an eighth so inserting rid after rid doesn't reallocate every time
+            self.words.frombytes(bytes(8 * max(rid + 1 - len(self.words), len(self.words) >> 3, 1024)))
+        if self.words[rid] == 0:
+            self.count += 1
+        self.words[rid] = pack_location(location)
+
+    def place(self, first_rid, page_type, range_index, first_offset, count):
+        # rids first_rid, first_rid + 1, ... go to consecutive slots from first_offset on, all words set in one step
+        last = first_rid + count
+        if last > len(self.words):
+            self.words.frombytes(bytes(8 * max(last - len(self.words), len(self.words) >> 3, 1024)))
+        self.count += self.words[first_rid:last].count(0)
+        first_word = pack_location((page_type, range_index, first_offset))
+        step = pack_location((page_type, 0, RECORD_SIZE)) - pack_location((page_type, 0, 0))
+        self.words[first_rid:last] = array('q', range(first_word, first_word + step * count, step))
+
+    def slots_by_range(self, rids, page_type = 'base'):
+        # {range index: [slot, ...]} of the rids located in pages of page_type, decoded straight from the words for scans
+        # over many rids (rids without a location, or of the other page type, are left out)
+        words = self.words
+        size = len(words)
+        code = LOCATION_TYPES.index(page_type)
+        ranges = {}
+        current = None # range of the last rid, rids in a row usually share it
+        for rid in rids:
+            if 0 <= rid < size:
+                word = words[rid]
+                if word & 3 == code:
+                    range_index = word >> (OFFSET_BITS + 2)
+                    if range_index != current:
+                        slots = ranges.setdefault(range_index, [])
+                        current = range_index
+                    slots.append(((word >> 2) & ((1 << OFFSET_BITS) - 1)) // RECORD_SIZE)
+        return ranges
+
+    def __delitem__(self, rid):
+        if rid not in self:
+            raise KeyError(rid)
+        self.words[rid] = 0
+        self.count -= 1
+
+    def pop(self, rid, default = None):
+        if rid not in self:
+            return default
+        location = self[rid]
+        del self[rid]
+        return location
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return (rid for rid, word in enumerate(self.words) if word)
+
+    def keys(self):
+        return iter(self)
+
+    def items(self):
+        # (rid, location) in rid order
+        return ((rid, unpack_location(word)) for rid, word in enumerate(self.words) if word)
+
+    def values(self):
+        return (location for rid, location in self.items())
+
+    def copy(self):
+        # Snapshot for a checkpoint: one copy of the word array, no per record objects
+        return PageDirectory(self.words[:])
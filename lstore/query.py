@@ -1,5 +1,24 @@
-from lstore.table import Table, Record
+from lstore.table import Table, Record, INDIRECTION_COLUMN
 from lstore.index import Index
+from lstore.Config import RECORD_SIZE
+
+# aggregate functions Query.aggregate accepts, each reduces a list of column values
+AGGREGATES = {
+    'sum': sum,
+    'count': len,
+    'min': min,
+    'max': max,
+    'avg': lambda values: sum(values) / len(values),
+}
+
+# the same aggregates over count records that all hold value, for groups answered from an index without reading them
+UNIFORM_AGGREGATES = {
+    'sum': lambda value, count: value * count,
+    'count': lambda value, count: count,
+    'min': lambda value, count: value,
+    'max': lambda value, count: value,
+    'avg': lambda value, count: value / 1,
+}
 
 
 class Query:
@@ -27,14 +46,14 @@ class Query:
             if not matching_rids:
                 return False
             rid = matching_rids[0] # get first matching RID
+            other_indexed = [i for i in self.table.index.indexed_columns() if i != key_column]
+            if other_indexed:
+                old_columns = self.table.get_record(rid).columns # values the other indexes hold the record under
             self.table.delete(rid) # call on the delete method to remove record
-            # delete from index 
-            btree = self.table.index.indices[key_column] 
-            rid_list = btree[primary_key]
-            rid_list.remove(rid)
-            # if no RIDs remain for this key, remove the key entirely
-            if len(rid_list) == 0: # if list is empty
-                del btree[primary_key] # delete the key (so no empty lists remain)
+            # delete from index, a key left without RIDs is removed entirely
+            self.table.index.delete_rid(key_column, primary_key, rid)
+            for i in other_indexed:
+                self.table.index.delete_rid(i, old_columns[i], rid)
             return True 
             # any issues or crash, return false
         except: 
@@ -72,6 +91,22 @@ class Query:
             return False
 
     
+    """
+    # Insert many records at once
+    # :param rows: list of rows, each a list of the column values like the arguments of insert
+    # Return True upon succesful insertion of every row
+    # Returns False (and inserts nothing) if a row is malformed or a key is duplicated or already taken
+    # Rows are written a whole column page at a time and the indexes are updated once at the end (see Table.bulk_load)
+    """
+    def insert_many(self, rows):
+        try:
+            rows = [list(row) for row in rows]
+            self.table.bulk_load(rows, batch_rows = max(1, len(rows)))
+            return True
+        except Exception:
+            return False
+
+    
     """
     # Read matching record with specified search key
     # :param search_key: the value you want to search based on
@@ -89,8 +124,8 @@ class Query:
             # store list of record objects
             results = []
             for rid in matching_rids: # go through each matching rid
-                # table's get_record method from table.py to get the full Record object
-                record = self.table.get_record(rid)
+                # table's get_record method from table.py to get the Record object, only the projected columns are read
+                record = self.table.get_record(rid, None, projected_columns_index)
                 if record is None: # skip if record dne or is none
                     continue
                 results.append(record)
@@ -101,6 +136,50 @@ class Query:
             return []
 
     
+    """
+    # Read the records matching several equality predicates at once
+    # :param predicates: dict column index -> value, a record has to match all of them
+    # :param projected_columns_index: what columns to return. array of 1 or 0 values.
+    # Returns a list of Record objects upon success
+    # The matching RIDs come from intersecting the columns' bitmap indexes (see Index.locate_all), records are only
+    # fetched for the RIDs left after the intersection
+    """
+    def select_where(self, predicates, projected_columns_index):
+        try:
+            results = []
+            for rid in self.table.index.locate_all(predicates):
+                record = self.table.get_record(rid, None, projected_columns_index)
+                if record is None:
+                    continue
+                results.append(record)
+            return results
+        except Exception:
+            return []
+
+    
+    """
+    # Read the records matching any of several search keys at once
+    # :param search_keys: the values you want to search based on
+    # :param search_key_index: the column index you want to search based on
+    # :param projected_columns_index: what columns to return. array of 1 or 0 values.
+    # Returns a list of Record objects upon success, the matches of each key in the order the keys were given
+    # Keys are resolved in one pass over the index and records are read a page range at a time (see Table.get_records)
+    """
+    def select_many(self, search_keys, search_key_index, projected_columns_index):
+        try:
+            search_keys = list(search_keys)
+            matching = self.table.index.locate_many(search_key_index, search_keys)
+            records = self.table.get_records([rid for rids in matching.values() for rid in rids], projected_columns_index)
+            results = []
+            for key in search_keys:
+                for rid in matching.get(key, []):
+                    if rid in records:
+                        results.append(records[rid])
+            return results
+        except Exception:
+            return []
+
+    
     """
     # Read matching record with specified search key
     # :param search_key: the value you want to search based on
@@ -124,12 +203,13 @@ class Query:
             results = []
             for rid in matching_rids:
                 # Get the record with the specified version
-                record = self.table.get_record(rid, relative_version)
+                record = self.table.get_record(rid, relative_version, projected_columns_index)
                 if record is None:
                     continue
                 results.append(record)
             
             # If we found records, return them; return false if not
+            return results
         except Exception:
             return []
     
@@ -158,20 +238,20 @@ class Query:
 
             old_version_info = self.table.get_record(rid).columns#grab the old version 
             for i in range(0, len(columns)):#iterate over columns
-                if self.table.index.indices[i] is not None:
+                if self.table.index.is_indexed(i):
                     self.table.index.delete_rid(i, old_version_info[i], rid)#delete older versions 
                     
             updating = self.table.update(rid, list(columns))#set what columns are updating 
-            tailRID = self.table.rid - 1
             
             for i in range(0, len(columns)):#iterate over columsn 
                 if i == self.table.key:#check if i is the same as key 
                     self.table.index.insert_btree(i, old_version_info[i], rid)#insert into table if it is 
-                elif self.table.index.indices[i] is not None:# if its not check if its none 
+                elif self.table.index.is_indexed(i):# if its not check if its none 
+                    #indexes always point at the base rid, get_record follows it to the newest version
                     if columns[i] is not None:# if it exists but is not in table 
-                        self.table.index.insert_btree(i, columns[i], tailRID)#insert it into table 
+                        self.table.index.insert_btree(i, columns[i], rid)#insert it into table 
                     else:
-                        self.table.index.insert_btree(i, old_version_info[i], tailRID)#keep the old version 
+                        self.table.index.insert_btree(i, old_version_info[i], rid)#keep the old version 
             return updating
             
         except:
@@ -199,17 +279,7 @@ class Query:
             
             key = self.table.key#set key 
             matching_rids = self.table.index.locate_range(start_range, end_range, key)#set matching rids from locate range 
-            sum_range = 0#initialize sum 
-            for rid in matching_rids:#for eachrid in matching rid
-                if rid not in self.table.page_directory:#skip if not in page directory 
-                    continue
-                page_type, range_index, offset = self.table.page_directory[rid]#set three criteria 
-                if page_type != 'base':#skip tails 
-                    continue
-                record = self.table.get_record(rid)#get record from rid 
-                if record is not None:#if the record exists
-                    sum_range += record.columns[aggregate_column_index]#add it to range
-            return sum_range
+            return self.sum_rids(matching_rids, aggregate_column_index)
         except Exception:
             return False
 
@@ -228,18 +298,7 @@ class Query:
             # The code should be the same as sum, but get_record will include relative_version in the parameters this time
             key_column = self.table.key
             matching_rids = self.table.index.locate_range(start_range, end_range, key_column)
-            sum_range = 0
-            for rid in matching_rids:
-                #Sage same fix as sum done again on sum version 
-                if rid not in self.table.page_directory:
-                    continue
-                page_type, range_index, offset = self.table.page_directory[rid]
-                if page_type != 'base':
-                    continue
-                record = self.table.get_record(rid, relative_version)
-                if record is not None:
-                    sum_range += record.columns[aggregate_column_index]
-            return sum_range
+            return self.sum_rids(matching_rids, aggregate_column_index, relative_version)
         except:
             return False
         # User inputs the range of values they're looking for, the column for what they want to sum, and the relative version of all the data
@@ -247,6 +306,84 @@ class Query:
         # 0 = Most updated version (current version)
 
     
+    # Adds up one column over the given base rids, shared by sum and sum_version
+    def sum_rids(self, matching_rids, aggregate_column_index, relative_version = None):
+        return sum(self.table.column_values(matching_rids, aggregate_column_index, relative_version))
+
+    
+    """
+    :param start_range: int         # Start of the key range to aggregate 
+    :param end_range: int           # End of the key range to aggregate 
+    :param aggregate_column_index: int  # Index of desired column to aggregate
+    :param agg_fn: string           # 'sum', 'count', 'min', 'max' or 'avg'
+    :param relative_version: the relative version of the records to aggregate (latest by default)
+    # Returns the aggregate of the column over the records whose key is in the range
+    # Returns False if min, max or avg find no record in the range (sum and count give 0)
+    # The column is read a page range at a time (see Table.column_values), no Record is built unless an older version is asked for
+    """
+    def aggregate(self, start_range, end_range, aggregate_column_index, agg_fn, relative_version = None):
+        try:
+            matching_rids = self.table.index.locate_range(start_range, end_range, self.table.key)
+            values = self.table.column_values(matching_rids, aggregate_column_index, relative_version)
+            if not values and agg_fn not in ('sum', 'count'):
+                return False
+            return AGGREGATES[agg_fn](values)
+        except Exception:
+            return False
+
+    """
+    :param group_column: int        # Index of the column whose values make the groups
+    :param agg_column: int          # Index of the column to aggregate in every group
+    :param agg_fn: string           # 'sum', 'count', 'min', 'max' or 'avg'
+    :param key_range: (int, int)    # Only records whose key is in this range, every record by default
+    # Returns a dict group value -> aggregate of agg_column over the records with that value, in group value order
+    # Both columns are read in one pass over the column pages (see Table.columns_values) and grouped in a dict. When the
+    # answer only needs each group's record count (count, or aggregating the grouping column itself) and group_column
+    # is indexed, it comes from the index alone without reading any page
+    """
+    def group_by(self, group_column, agg_column, agg_fn, key_range = None):
+        try:
+            aggregate = AGGREGATES[agg_fn]
+            index = self.table.index
+            groups = {}
+            if index.is_indexed(group_column) and (agg_fn == 'count' or agg_column == group_column):
+                if index.needs_rebuild:
+                    index.rebuild_indices()
+                in_range = None
+                if key_range is not None:
+                    in_range = index.locate_range(key_range[0], key_range[1], self.table.key)
+                uniform = UNIFORM_AGGREGATES[agg_fn] # every record of a group holds its value in group_column
+                return {value: uniform(value, count) for value, count in index.group_counts(group_column, in_range) if count}
+            else:
+                if key_range is None:
+                    matching_rids = index.locate_range(-(1 << 63), (1 << 63) - 1, self.table.key)
+                else:
+                    matching_rids = index.locate_range(key_range[0], key_range[1], self.table.key)
+                group_values, agg_values = self.table.columns_values(matching_rids, [group_column, agg_column])
+                for value, agg_value in zip(group_values, agg_values):
+                    values = groups.get(value)
+                    if values is None:
+                        groups[value] = [agg_value]
+                    else:
+                        values.append(agg_value)
+            return {value: aggregate(groups[value]) for value in sorted(groups)}
+        except Exception:
+            return False
+
+    # aggregate over a key range with one function, same arguments and results as sum
+    def count(self, start_range, end_range, aggregate_column_index):
+        return self.aggregate(start_range, end_range, aggregate_column_index, 'count')
+
+    def min(self, start_range, end_range, aggregate_column_index):
+        return self.aggregate(start_range, end_range, aggregate_column_index, 'min')
+
+    def max(self, start_range, end_range, aggregate_column_index):
+        return self.aggregate(start_range, end_range, aggregate_column_index, 'max')
+
+    def avg(self, start_range, end_range, aggregate_column_index):
+        return self.aggregate(start_range, end_range, aggregate_column_index, 'avg')
+
+    
     """
     incremenets one column of the record
     this implementation should work if your select and update queries already work
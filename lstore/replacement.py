@@ -0,0 +1,159 @@
+from collections import OrderedDict
+from itertools import chain
+
+"""
+Replacement policies for the BufferPool. A policy only tracks page keys, the pool keeps the pages themselves.
+Every policy has the same methods:
+  insert(key)  a page was brought into the pool
+  touch(key)   a page already in the pool was used again
+  remove(key)  a page left the pool (evicted or dropped)
+  victims()    keys in the order they should be evicted, the pool skips the ones it can't evict (pinned, being written)
+               and stops iterating before it removes anything
+  coldest(n)   up to n keys eviction would look at next, without changing any policy state
+  ranked()     every key, hottest first, without changing any policy state (saved on close to warm up the next open)
+"""
+
+
+class LRUPolicy: # plain least recently used, what the pool always did with OrderedDict.move_to_end
+    def __init__(self, capacity):
+        self.order = OrderedDict() # oldest key at the front
+
+    def insert(self, key):
+        self.order[key] = None
+
+    def touch(self, key):
+        self.order.move_to_end(key)
+
+    def remove(self, key):
+        self.order.pop(key, None)
+
+    def victims(self):
+        return iter(self.order)
+
+    def coldest(self, n):
+        keys = []
+        for key in self.order:
+            if len(keys) >= n:
+                break
+            keys.append(key)
+        return keys
+
+    def ranked(self):
+        return list(reversed(self.order))
+
+
+class ClockPolicy: # CLOCK sweep: one reference bit per frame, the hand clears bits until it finds a frame that wasn't used
+    def __init__(self, capacity):
+        self.frames = [] # ring of keys, None marks a free frame
+        self.referenced = [] # reference bit of each frame
+        self.position = {} # key -> frame index
+        self.free = [] # indexes of free frames
+        self.hand = 0
+
+    def insert(self, key):
+        if self.free:
+            index = self.free.pop()
+            self.frames[index] = key
+            self.referenced[index] = False # a new page has to be used again before it survives a sweep
+        else:
+            index = len(self.frames)
+            self.frames.append(key)
+            self.referenced.append(False)
+        self.position[key] = index
+
+    def touch(self, key):
+        self.referenced[self.position[key]] = True
+
+    def remove(self, key):
+        index = self.position.pop(key, None)
+        if index is not None:
+            self.frames[index] = None
+            self.referenced[index] = False
+            self.free.append(index)
+
+    def victims(self):
+        # Sweeps at most two full turns: the first turn clears reference bits, the second one is sure to find frames
+        for step in range(2 * len(self.frames)):
+            index = self.hand
+            self.hand = (self.hand + 1) % len(self.frames)
+            key = self.frames[index]
+            if key is None:
+                continue
+            if self.referenced[index]:
+                self.referenced[index] = False # second chance
+                continue
+            yield key
+
+    def coldest(self, n):
+        keys = []
+        for step in range(len(self.frames)):
+            if len(keys) >= n:
+                break
+            index = (self.hand + step) % len(self.frames)
+            if self.frames[index] is not None and not self.referenced[index]:
+                keys.append(self.frames[index])
+        return keys
+
+    def ranked(self):
+        # Frames with the reference bit set were used since the hand last passed them so they count as hotter
+        used = [key for index, key in enumerate(self.frames) if key is not None and self.referenced[index]]
+        unused = [key for index, key in enumerate(self.frames) if key is not None and not self.referenced[index]]
+        return used + unused
+
+
+class TwoQPolicy: # 2Q: new pages wait in a FIFO and only move to the main LRU once they are used again later on
+    def __init__(self, capacity, in_fraction = 0.25, out_fraction = 0.5):
+        self.in_size = max(1, int(capacity * in_fraction)) # target size of the A1in FIFO
+        self.out_size = max(1, int(capacity * out_fraction)) # how many evicted keys are remembered in A1out
+        self.correlation = max(1, int(capacity * in_fraction)) # uses closer together than this many accesses count as one
+        self.a1in = OrderedDict() # pages seen once -> access clock when they came in, first in first out
+        self.a1out = OrderedDict() # keys (no pages) recently evicted from A1in
+        self.am = OrderedDict() # pages that proved they are hot, LRU
+        self.clock = 0 # counts inserts and touches
+
+    def insert(self, key):
+        self.clock += 1
+        if key in self.a1out:
+            # used again soon after being evicted: this page is really hot
+            del self.a1out[key]
+            self.am[key] = None
+        else:
+            self.a1in[key] = self.clock
+
+    def touch(self, key):
+        self.clock += 1
+        if key in self.am:
+            self.am.move_to_end(key)
+        elif self.clock - self.a1in[key] > self.correlation:
+            # used again well after it came in (not just the put_page right after a get_page): promote it
+            del self.a1in[key]
+            self.am[key] = None
+
+    def remove(self, key):
+        if key in self.a1in:
+            del self.a1in[key]
+            self.a1out[key] = None
+            if len(self.a1out) > self.out_size:
+                self.a1out.popitem(last = False)
+        else:
+            self.am.pop(key, None)
+
+    def victims(self):
+        # A scan only ever fills A1in so it gets evicted first, Am is left alone while A1in is over its share
+        if len(self.a1in) > self.in_size or not self.am:
+            return chain(self.a1in, self.am)
+        return chain(self.am, self.a1in)
+
+    def coldest(self, n):
+        keys = []
+        for key in self.victims():
+            if len(keys) >= n:
+                break
+            keys.append(key)
+        return keys
+
+    def ranked(self):
+        return list(reversed(self.am)) + list(reversed(self.a1in))
+
+
+REPLACEMENT_POLICIES = {'lru': LRUPolicy, 'clock': ClockPolicy, '2q': TwoQPolicy} # replacement option -> policy class
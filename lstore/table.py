@@ -1,7 +1,14 @@
 from lstore.index import Index
 from lstore.page import Page
 from lstore.bufferpool import BufferPool
-from time import time
+from lstore.page_directory import PageDirectory, pack_location, unpack_location, read_directory, write_directory, append_changes
+from lstore.Config import RECORD_SIZE
+from contextlib import contextmanager
+from operator import itemgetter
+from time import time, time_ns
+import os
+import io
+import struct
 
 # Layout of columns in metadata: [0] indirection, [1] rid, [2] timestamp, [3] schema encoding
 INDIRECTION_COLUMN = 0
@@ -9,6 +16,13 @@ RID_COLUMN = 1
 TIMESTAMP_COLUMN = 2
 SCHEMA_ENCODING_COLUMN = 3
 
+# zones.bin: header (magic, number of entries), then one (base range index, column, min, max) entry per zone
+ZONE_HEADER = struct.Struct('<8sq')
+ZONE_ENTRY = struct.Struct('<qqqq')
+ZONE_MAGIC = b'LSTORZON'
+EMPTY_ZONE = ((1 << 63) - 1, -(1 << 63)) # zone of a page nothing was written to yet, min > max so it never matches
+BULK_BATCH_ROWS = 65536 # rows bulk_load checks, writes and indexes at a time
+
 class Record:
 
     def __init__(self, rid, key, columns):
@@ -28,7 +42,7 @@ class Table:
     :param num_columns: int     #Number of Columns: all columns are integer
     :param key: int             #Index of table key in columns
     """
-    def __init__(self, name, num_columns, key, loading = False, db_path="./ECS165"):
+    def __init__(self, name, num_columns, key, loading = False, db_path="./ECS165", bufferpool = None):
         self.name = name
         #self.bufferpool = Bufferpool(capacity = 100) # Iris: sets up bufferpool
         #self.pagekey = list(range(100)) # Iris: page keys in this bufferpool will just be integers 
@@ -37,7 +51,7 @@ class Table:
         # so pool looks like {0:somepage, 1:empty, ..., 100:somepage100}
         self.key = key
         self.num_columns = num_columns
-        self.page_directory = {} # dictionary to store data and offset under RIDS
+        self.page_directory = PageDirectory() # stores page type, range and offset under RIDS, used like a dict
         self.index = Index(self)
         self.merge_threshold_pages = 10  # The threshold to trigger a merge: M2 
         self.rid = 0
@@ -47,7 +61,18 @@ class Table:
         self.cur_tail_range_index = -1 # the greater range index for base pages
         self.cur_base_range_index = -1 # the greater range index for base pages
 
-        self.bufferpool = BufferPool(capacity=50, path=db_path)#set bufferpool
+        #tables of a database all share the database's bufferpool, a table made on its own gets a private one
+        self.bufferpool = bufferpool if bufferpool is not None else BufferPool(capacity=50, path=db_path)#set bufferpool
+        self.wal = None # the database's write-ahead log, every change is logged before it is made when there is one
+        self.op_lock = None # the database's operation lock, a checkpoint holds it while it takes its snapshot
+        self.db_path = db_path
+        self.directory_changes = None # rid -> location (None = removed) since the last checkpoint, None if nothing checkpoints this table
+        self.directory_entries = -1 # entries in directory.log, -1 until this table's directory files are known to be its own
+        self.directory_generation = 0 # generation of directory.bin, see page_directory.py
+        # (base range index, column) -> [min, max] covering every value written to that column's base page, scans skip
+        # pages whose zone can't match. Zones only ever grow so one saved by any checkpoint since is still safe to use
+        self.zone_maps = {}
+        self.zones_changed = False # zone_maps changed since the last checkpoint saved them
     
     
     def get_page(self, page_type, idx, col):#Sage: helper function to get page from bufferpool
@@ -55,32 +80,306 @@ class Table:
         
     def put_page(self, page_type, idx, col, page):#Sage: helper function to put page into bufferpool
         self.bufferpool.put_page(self.name, page_type, idx, col, page)
+
+    def pinned(self, page_type, idx, col, dirty = False):# keeps a page pinned for a whole with block, dirty=True if it gets changed
+        return self.bufferpool.pinned((self.name, page_type, idx, col), dirty)
+
+    def read_ahead(self, page_type, cols, start = 0):# tells the bufferpool a scan is about to walk these columns range by range
+        self.bufferpool.read_ahead_hint(self.name, page_type, cols, start)
+
+    def log(self, record):# appends a record to the write-ahead log, returns its lsn (0 when there is no log)
+        if self.wal is None:
+            return 0
+        return self.wal.append(record)
+
+    def commit(self):# makes the logged changes of one operation durable
+        if self.wal is not None:
+            self.wal.commit()
+
+    @contextmanager
+    def operation(self, commit = True):# one insert/update/delete/merge step: a checkpoint never sees it half done, its log records are committed after
+        if self.op_lock is None:
+            yield
+        else:
+            with self.op_lock:
+                yield
+        if commit:
+            self.commit()
+
+    def set_location(self, rid, location):# changes the page directory (None removes the rid) and logs it
+        self.log(('dir', self.name, rid, location))
+        if location is None:
+            del self.page_directory[rid]
+        else:
+            self.page_directory[rid] = location
+        if self.directory_changes is not None:
+            self.directory_changes[rid] = location
+
+    def directory_path(self):# folder holding directory.bin and directory.log
+        return self.db_path + "/" + self.name
+
+    def load_directory(self):# page_directory as of the last checkpoint: the rid indexed snapshot plus the changes logged after it
+        words, self.directory_generation, changes = read_directory(self.directory_path())
+        if words is not None:
+            self.page_directory = PageDirectory.from_words(words)#one copy out of the mapping, nothing decoded
+        for rid, word in changes:
+            if word:
+                self.page_directory[rid] = unpack_location(word)
+            else:
+                self.page_directory.pop(rid, None)
+        self.directory_entries = len(changes)
+
+    def take_directory_changes(self):# called by a checkpoint while operations are held off, returns (full, entries) for save_directory
+        changes = self.directory_changes
+        self.directory_changes = {}
+        if self.directory_entries < 0 or self.directory_entries + len(changes) > len(self.page_directory) + 1024:
+            return True, self.page_directory.copy()#the log would be longer than a new snapshot: rewrite it
+        return False, list(changes.items())
+
+    def save_directory(self, full, entries):# appends the changes to directory.log, or writes a full snapshot when full
+        if full:
+            self.directory_generation = time_ns()#never matches a log left behind by an earlier table of the same name
+            write_directory(self.directory_path(), entries.words, self.directory_generation)
+            self.directory_entries = 0
+        else:
+            append_changes(self.directory_path(), [(rid, pack_location(location)) for rid, location in entries], self.directory_generation)
+            self.directory_entries += len(entries)
+
+    def write_row(self, page_type, idx, first_col, offset, values):# logs then writes values into one slot of columns first_col, first_col + 1, ... of a page range
+        lsn = self.log(('row', self.name, page_type, idx, first_col, offset, values))
+        if page_type == 'base':
+            self.widen_zones(idx, first_col, values)
+        for col, value in enumerate(values, first_col):
+            with self.pinned(page_type, idx, col, dirty=True) as page:
+                self.write_slot(page, offset, value, lsn)
+
+    def write_slot(self, page, offset, value, lsn):# stores one value, the page counts every slot up to offset as used
+        page.update(offset, value)
+        if page.num_records <= offset // RECORD_SIZE:
+            page.num_records = offset // RECORD_SIZE + 1
+        if lsn:
+            page.lsn = lsn
+
+    def write_column(self, page_type, idx, col, offset, values):# logs then writes values into consecutive slots of one column page from offset on
+        lsn = self.log(('fill', self.name, page_type, idx, col, offset, values))
+        if page_type == 'base' and col >= 4:
+            self.widen_zone(idx, col - 4, min(values), max(values))
+        with self.pinned(page_type, idx, col, dirty=True) as page:
+            self.write_slots(page, offset, values, lsn)
+
+    def write_slots(self, page, offset, values, lsn):# write_slot for a run of slots
+        page.update_many(offset, values)
+        if page.num_records < offset // RECORD_SIZE + len(values):
+            page.num_records = offset // RECORD_SIZE + len(values)
+        if lsn:
+            page.lsn = lsn
+
+    def place_rows(self, first_rid, idx, offset, count, logged = True):# set_location for count new base records in consecutive slots, logged as one record
+        if logged:
+            self.log(('place', self.name, first_rid, idx, offset, count))
+        self.page_directory.place(first_rid, 'base', idx, offset, count)
+        if self.directory_changes is not None:
+            self.directory_changes.update([(first_rid + position, ('base', idx, offset + position * RECORD_SIZE)) for position in range(count)])
+
+    def widen_zones(self, idx, first_col, values):# stretches the zones of base range idx over values written at columns first_col, ...
+        for col, value in enumerate(values, first_col - 4):
+            if col < 0 or value is None:#metadata columns have no zones, None is a delete and the record is gone
+                continue
+            self.widen_zone(idx, col, value, value)
+
+    def widen_zone(self, idx, col, low, high):
+        zone = self.zone_maps.get((idx, col))
+        if zone is None:#not known yet, zone() works it out from the page with these values in it
+            return
+        if low < zone[0]:
+            zone[0] = low
+            self.zones_changed = True
+        if high > zone[1]:
+            zone[1] = high
+            self.zones_changed = True
+
+    def zone(self, idx, col):# [min, max] of column col in base range idx, read from the page the first time it is needed
+        zone = self.zone_maps.get((idx, col))
+        if zone is None:
+            with self.operation(commit = False):#no write lands between reading the page and keeping its zone
+                zone = self.zone_maps.get((idx, col))
+                if zone is None:
+                    page = self.get_page('base', idx, 4 + col)
+                    values = page.read_all()[:page.num_records]
+                    zone = self.zone_maps[(idx, col)] = [min(values, default = EMPTY_ZONE[0]), max(values, default = EMPTY_ZONE[1])]
+                    self.zones_changed = True
+        return zone
+
+    def take_zones(self):# called by a checkpoint while operations are held off, returns the entries for save_zones (None if unchanged)
+        if not self.zones_changed:
+            return None
+        self.zones_changed = False
+        return [(idx, col, zone[0], zone[1]) for (idx, col), zone in self.zone_maps.items()]
+
+    def save_zones(self, entries):# replaces zones.bin with entries from take_zones
+        if entries is None:
+            return
+        try:
+            os.makedirs(self.directory_path(), exist_ok = True)
+            path = self.directory_path() + "/zones.bin"
+            zones_file = io.open(path + ".tmp", 'wb')
+            zones_file.write(ZONE_HEADER.pack(ZONE_MAGIC, len(entries)) + b''.join([ZONE_ENTRY.pack(*entry) for entry in entries]))
+            zones_file.flush()
+            os.fsync(zones_file.fileno())
+            zones_file.close()
+            os.replace(path + ".tmp", path)
+        except Exception:
+            self.zones_changed = True#the next checkpoint tries again
+            raise
+
+    def load_zones(self):# zones saved by the last checkpoint, ranges without one get it from their page when first scanned
+        path = self.directory_path() + "/zones.bin"
+        if not os.path.exists(path):
+            return
+        zones_file = io.open(path, 'rb')
+        data = zones_file.read()
+        zones_file.close()
+        if len(data) < ZONE_HEADER.size or ZONE_HEADER.unpack_from(data, 0)[0] != ZONE_MAGIC:
+            return
+        count = ZONE_HEADER.unpack_from(data, 0)[1]
+        for idx, col, low, high in ZONE_ENTRY.iter_unpack(data[ZONE_HEADER.size:ZONE_HEADER.size + count * ZONE_ENTRY.size]):
+            self.zone_maps[(idx, col)] = [low, high]
+
+    def redo(self, lsn, record):# replays one log record during recovery, pages that already have it (page lsn >= lsn) are left alone
+        kind = record[0]
+        if kind == 'row':
+            page_type, idx, first_col, offset, values = record[2:]
+            if page_type == 'base':#zones only grow, widening by a value the page already has changes nothing
+                self.widen_zones(idx, first_col, values)
+            for col, value in enumerate(values, first_col):
+                page = self.bufferpool.fetch((self.name, page_type, idx, col))
+                if page is None:#the page never made it to disk
+                    self.put_page(page_type, idx, col, Page())
+                    page = self.bufferpool.fetch((self.name, page_type, idx, col))
+                changed = page.lsn < lsn
+                if changed:
+                    self.write_slot(page, offset, value, lsn)
+                self.bufferpool.unpin((self.name, page_type, idx, col), changed)
+        elif kind == 'fill':
+            page_type, idx, col, offset, values = record[2:]
+            if page_type == 'base' and col >= 4:
+                self.widen_zone(idx, col - 4, min(values), max(values))
+            page = self.bufferpool.fetch((self.name, page_type, idx, col))
+            if page is None:
+                self.put_page(page_type, idx, col, Page())
+                page = self.bufferpool.fetch((self.name, page_type, idx, col))
+            changed = page.lsn < lsn
+            if changed:
+                self.write_slots(page, offset, values, lsn)
+            self.bufferpool.unpin((self.name, page_type, idx, col), changed)
+        elif kind == 'place':
+            first_rid, idx, offset, count = record[2:]
+            self.place_rows(first_rid, idx, offset, count, logged = False)
+            self.rid = max(self.rid, first_rid + count)
+        elif kind == 'dir':
+            rid, location = record[2:]
+            if location is None:
+                self.page_directory.pop(rid, None)
+            else:
+                location = self.page_directory[rid] = tuple(location)
+            if self.directory_changes is not None:
+                self.directory_changes[rid] = location
+            self.rid = max(self.rid, rid + 1)#never hand out a rid the log already used
+        elif kind == 'index':#contents come from the rebuild after recovery
+            column, index_kind = record[2:]
+            self.index.define(column, index_kind)
+        elif kind == 'drop_index':
+            column, index_kind = record[2:]
+            self.index.drop_index(column, index_kind, logged = False)
+        elif kind == 'range':
+            page_type, idx = record[2:]
+            if page_type == 'base':
+                self.cur_base_range_index = max(self.cur_base_range_index, idx)
+                for col in range(self.num_columns):#every row of the range comes after this record, redo widens the zones over them
+                    self.zone_maps.setdefault((idx, col), list(EMPTY_ZONE))
+            else:
+                self.cur_tail_range_index = max(self.cur_tail_range_index, idx)
+            for col in range(self.total_columns):
+                if self.get_page(page_type, idx, col) is None:
+                    self.put_page(page_type, idx, col, Page())
         
     def insert(self, values): # Nicholas & Sage 
         if len(values) == self.num_columns:#check 
-            
-            if not self.get_page('base', self.cur_base_range_index, 0).has_capacity():#Sge new bufferpool check capacity
-                self.new_base_page_range()
-            
-            rid = self.rid # set rid for insert
-            self.rid += 1 # increase rid by one to indicate new rid
+            with self.operation():
+                if not self.get_page('base', self.cur_base_range_index, 0).has_capacity():#Sge new bufferpool check capacity
+                    self.new_base_page_range()
                 
+                rid = self.rid # set rid for insert
+                self.rid += 1 # increase rid by one to indicate new rid
                     
-            # Insert the value into each column's page
-            all_columns = [0, rid, int(time()), 0] + list(values) # this is the all column which stores [indirection, RID, time made, schema encoding] 
-            offset = None # reset offset 
-            for col, value in enumerate(all_columns):#iterate though each part of all columns and stores value and METADATA in col FIXED FOR BUFFERPOOL
-                page = self.get_page('base', self.cur_base_range_index, col)#set page to be stored
-                offset = page.write(value)#write the value to the page
-                self.put_page('base', self.cur_base_range_index, col, page)#put the new page into bufferpool
-            #store the range index and the offset to the page directory 
-            self.page_directory[rid] = ('base', self.cur_base_range_index, offset)
+                        
+                # Insert the value into each column's page
+                all_columns = [0, rid, int(time()), 0] + list(values) # this is the all column which stores [indirection, RID, time made, schema encoding] 
+                offset = self.get_page('base', self.cur_base_range_index, 0).num_records * RECORD_SIZE # next free slot, the same in every column
+                self.write_row('base', self.cur_base_range_index, 0, offset, all_columns)#log and write the value and METADATA of every column
+                #store the range index and the offset to the page directory 
+                self.set_location(rid, ('base', self.cur_base_range_index, offset))
             return rid              
             
         else:
             return False
 
-    
+    def bulk_load(self, rows, batch_rows = BULK_BATCH_ROWS):# Loads an iterable of rows (lists of num_columns values), returns how many were loaded
+        # Rows are taken batch_rows at a time: the batch's keys are checked in one sorted pass, then it is written a
+        # whole column page at a time (one log record per column page) and the indexes get the batch at the end
+        # Raises ValueError before writing anything of a batch that has a bad row or a key that is already taken,
+        # the batches before it stay loaded
+        loaded = 0
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_rows:
+                loaded += self.load_batch(batch)
+                batch = []
+        if batch:
+            loaded += self.load_batch(batch)
+        return loaded
+
+    def load_batch(self, rows):# one batch of bulk_load
+        for row in rows:
+            if len(row) != self.num_columns:
+                raise ValueError("Row has " + str(len(row)) + " values, table " + self.name + " has " + str(self.num_columns) + " columns")
+        # None is stored as 0 (like insert), converted up front so the zones and indexes see what the pages hold
+        rows = [[0 if value is None else value for value in row] for row in rows]
+        keys = sorted(row[self.key] for row in rows)
+        for previous, key in zip(keys, keys[1:]):
+            if previous == key:
+                raise ValueError("Duplicate key " + str(key))
+        taken = self.index.locate_many(self.key, keys)
+        for key in keys:
+            if taken[key]:
+                raise ValueError("Duplicate key " + str(key))
+        new_rids = []
+        with self.operation():
+            now = int(time())
+            position = 0
+            while position < len(rows):
+                if not self.get_page('base', self.cur_base_range_index, 0).has_capacity():
+                    self.new_base_page_range()
+                first_page = self.get_page('base', self.cur_base_range_index, 0)
+                start = first_page.num_records
+                count = min(first_page.capacity - start, len(rows) - position)
+                first_rid = self.rid
+                self.rid += count
+                rids = list(range(first_rid, first_rid + count))
+                chunk = rows[position:position + count]
+                # [indirection, RID, time made, schema encoding] then the user columns, one list per column
+                all_columns = [[0] * count, rids, [now] * count, [0] * count] + [list(values) for values in zip(*chunk)]
+                for col, values in enumerate(all_columns):
+                    self.write_column('base', self.cur_base_range_index, col, start * RECORD_SIZE, values)
+                self.place_rows(first_rid, self.cur_base_range_index, start * RECORD_SIZE, count)
+                new_rids.extend(rids)
+                position += count
+            if not self.index.needs_rebuild:#a pending rebuild reads the new rows from the pages anyway
+                for col in self.index.indexed_columns():
+                    self.index.insert_many(col, [(row[col], rid) for row, rid in zip(rows, new_rids)])
+        return len(rows)
+
     def update(self, rid, values): # Sage 
         if rid not in self.page_directory:#check if its not in the page directory 
             return False
@@ -88,40 +387,38 @@ class Table:
         #get base range index and base offset from the page directory and page type M2
         page_type, base_range_index, base_offset = self.page_directory[rid]
         #Sage: new bufferpool implimentation 
-        base_direction_page = self.get_page('base', base_range_index, INDIRECTION_COLUMN)#grab pages indirection page
-        old_indirection = base_direction_page.read(base_offset)#set old indirection 
-        
-        #get the current record via the RID
-        current_record = self.get_record(rid)
-        #store a copy of current record into tail columns 
-        tail_columns = current_record.columns.copy()
-        for i, val in enumerate(values):
-            if val is not None:
-                tail_columns[i] = val
-        # schema encoding calculation
-        schema_encoding = 0
-        for i, val in enumerate(values):
-            if val is not None:
-                schema_encoding += (1 << i)# reads the value of i as a bit map
-        
-        #create new tail RID 
-        tail_rid = self.rid
-        self.rid += 1
-
-        tail_range_idx = self.get_current_tail_pages()#grab current tail pages
-        all_columns = [old_indirection, tail_rid, int(time()), schema_encoding] + tail_columns#set all columns for iterations
-
-        tail_offset = None#set tail offset 
-        for col, value in enumerate(all_columns):#iterate over all columns 
-            page = self.get_page('tail', tail_range_idx, col)#grab page
-            tail_offset = page.write(value)#write page offset 
-            self.put_page('tail', tail_range_idx, col, page)#put page back into bufferpool
+        #the indirection page stays pinned until the new tail is linked in so it can't be evicted while we hold it
+        with self.operation(), self.pinned('base', base_range_index, INDIRECTION_COLUMN, dirty=True) as base_direction_page:#grab pages indirection page
+            old_indirection = base_direction_page.read(base_offset)#set old indirection 
+            
+            #get the current record via the RID
+            current_record = self.get_record(rid)
+            #store a copy of current record into tail columns 
+            tail_columns = current_record.columns.copy()
+            for i, val in enumerate(values):
+                if val is not None:
+                    tail_columns[i] = val
+            # schema encoding calculation
+            schema_encoding = 0
+            for i, val in enumerate(values):
+                if val is not None:
+                    schema_encoding += (1 << i)# reads the value of i as a bit map
             
-        self.page_directory[tail_rid] = ('tail', tail_range_idx, tail_offset)#set the tail rid 
+            #create new tail RID 
+            tail_rid = self.rid
+            self.rid += 1
+
+            tail_range_idx = self.get_current_tail_pages()#grab current tail pages
+            all_columns = [old_indirection, tail_rid, int(time()), schema_encoding] + tail_columns#set all columns for iterations
+
+            tail_offset = self.get_page('tail', tail_range_idx, 0).num_records * RECORD_SIZE#next free tail slot
+            self.write_row('tail', tail_range_idx, 0, tail_offset, all_columns)#log and write every column of the tail record
+                
+            self.set_location(tail_rid, ('tail', tail_range_idx, tail_offset))#set the tail rid 
 
-        # update base indirection to point to new tail
-        base_direction_page.update(base_offset, tail_rid)
-        self.put_page('base', base_range_index, INDIRECTION_COLUMN, base_direction_page)
+            # update base indirection to point to new tail
+            lsn = self.log(('row', self.name, 'base', base_range_index, INDIRECTION_COLUMN, base_offset, [tail_rid]))
+            self.write_slot(base_direction_page, base_offset, tail_rid, lsn)
         
         return True
         
@@ -134,12 +431,10 @@ class Table:
         if rid in self.page_directory:#check if the RID exists in page directory
             page_type, range_index, offset = self.page_directory[rid]#grab the three criteria as normal 
             
-            for col in range(self.total_columns):#iterate over total columns 
-                page = self.get_page('base', range_index, col)#grab page 
-                page.update(offset, None)#update it to none to delete it 
-                self.put_page('base', range_index, col, page)#put deleted apge back into directory 
+            with self.operation():
+                self.write_row('base', range_index, 0, offset, [None] * self.total_columns)#update every column to none to delete it 
 
-            del self.page_directory[rid]#delete rid from page directory 
+                self.set_location(rid, None)#delete rid from page directory 
             return True
            
         else:
@@ -150,14 +445,19 @@ class Table:
     def new_base_page_range(self):# Sage fixeed for bufferpool
         new_idx = self.cur_base_range_index + 1#make index
         self.cur_base_range_index = new_idx#set index
+        self.log(('range', self.name, 'base', new_idx))
+        for col in range(self.num_columns):
+            self.zone_maps[(new_idx, col)] = list(EMPTY_ZONE)#widened by every insert into the range
+        self.zones_changed = True
         for col in range(self.total_columns):
-            self.put_page('base', new_idx, col, Page(capacity=512))#put pages in bufferpool
+            self.put_page('base', new_idx, col, Page())#put pages in bufferpool
 
     def new_tail_page_range(self):# Sage fixxed for bufferpool 
         new_idx = self.cur_tail_range_index + 1#make a new index 
         self.cur_tail_range_index = new_idx#set the new index
+        self.log(('range', self.name, 'tail', new_idx))
         for col in range(self.total_columns):
-            self.put_page('tail', new_idx, col, Page(capacity=512))#put pages into bufferpool
+            self.put_page('tail', new_idx, col, Page())#put pages into bufferpool
 
     def get_current_tail_pages(self):# Sage 
         #get current tail page range and create if needed
@@ -167,22 +467,28 @@ class Table:
             self.new_tail_page_range()#return the page range 
         return self.cur_tail_range_index#return the index of the page range
 
-    def get_record(self, rid, page_version = None):# Sage
+    def get_record(self, rid, page_version = None, projected_columns_index = None):# Sage
         # Grabs a record from using its RID. If page is less than 0 then we grab a tail record instead.
+        # projected_columns_index is a list of 1 or 0 per column: only the pages of the 1 columns are read and
+        # record.columns holds just those values in column order (None reads every column)
         if rid in self.page_directory:#in the page directory 
             page_type, base_range_index, base_offset = self.page_directory[rid]# set the index and offset simultaniously via RID
             
             #pagekey = self.get_pagekey(base_offset) # Iris: inserts page into bufferpool, also checks in page is in bufferpool already, returns pagekey
 
+            if projected_columns_index is None:
+                projected = list(range(self.num_columns))
+            else:
+                projected = [col for col, wanted in enumerate(projected_columns_index) if wanted]
             indirection = self.get_page('base', base_range_index, INDIRECTION_COLUMN).read(base_offset)
             columns = []
             
-            for col in range(4,self.total_columns): # iterate through each column. Change 4 to METADATA COLUMN 
-                value = self.get_page('base', base_range_index, col).read(base_offset)#new bufferpool setting and getting 
+            for col in projected: # iterate through each projected column
+                value = self.get_page('base', base_range_index, 4 + col).read(base_offset)#new bufferpool setting and getting 
                 columns.append(value)
             if indirection != 0: #If version of record is requested and record has tail pages then we apply tail updates.
-                columns = self.tail_update(columns, indirection, page_version)#take all the columns and the in direction to update tail
-            key = columns[self.key] 
+                columns = self.tail_update(columns, indirection, page_version, projected)#take all the columns and the in direction to update tail
+            key = columns[projected.index(self.key)] if self.key in projected else None
             # Creates record and its indirection then returns full record
             record = Record(rid, key, columns)
             record.indirection = indirection 
@@ -190,13 +496,95 @@ class Table:
         else:
             return None#not in the page directory
             
-    def tail_update(self, base_columns, tail_rid, version= None):# sage tail update and partial merge because select versions requires a tail update? 
+    def get_records(self, rids, projected_columns_index = None):# {rid: Record} of the latest versions, same as get_record for each rid
+        # Rids are grouped by page range so every page a projected column needs is fetched and decoded once for all of
+        # them, records with updates take their values from the newest tail record, grouped by tail range the same way
+        if projected_columns_index is None:
+            projected = list(range(self.num_columns))
+        else:
+            projected = [col for col, wanted in enumerate(projected_columns_index) if wanted]
+        base_ranges = {}#base range index -> [(rid, slot)]
+        for rid in rids:
+            location = self.page_directory.get(rid)
+            if location is not None and location[0] == 'base':
+                base_ranges.setdefault(location[1], []).append((rid, location[2] // RECORD_SIZE))
+        records = {}
+        tail_ranges = {}#tail range index -> [(record, slot)] of records whose latest values are in that tail range
+        for range_index, slots in base_ranges.items():
+            indirections = self.get_page('base', range_index, INDIRECTION_COLUMN).read_all()
+            pages = [self.get_page('base', range_index, 4 + col).read_all() for col in projected]
+            for rid, slot in slots:
+                record = records[rid] = Record(rid, None, [values[slot] for values in pages])
+                record.indirection = indirections[slot]
+                tail = self.page_directory.get(record.indirection) if record.indirection != 0 else None
+                if tail is not None:
+                    tail_ranges.setdefault(tail[1], []).append((record, tail[2] // RECORD_SIZE))
+        for range_index, slots in tail_ranges.items():
+            pages = [self.get_page('tail', range_index, 4 + col).read_all() for col in projected]
+            for record, slot in slots:
+                record.columns = [values[slot] for values in pages]
+        if self.key in projected:
+            position = projected.index(self.key)
+            for record in records.values():
+                record.key = record.columns[position]
+        return records
+
+    def column_values(self, rids, column, relative_version = None):# values of one column for base rids (latest version by default), read a page range at a time
+        return self.columns_values(rids, [column], relative_version)[0]
+
+    def columns_values(self, rids, columns, relative_version = None):# column_values for several columns, one list per column with the i-th value of each from the same record
+        # Base values are picked out of each range's page in one itemgetter call, records with updates take theirs from
+        # the newest tail record, picked the same way once per tail range. Older versions go through get_record
+        wanted = sorted(set(columns))
+        base_ranges = self.page_directory.slots_by_range(rids)
+        values = [[] for col in wanted]
+        tail_rids = []#newest tail record of every updated record
+        projection = [1 if col in wanted else 0 for col in range(self.num_columns)]
+        for range_index, slots in base_ranges.items():
+            if not values[0] and not tail_rids:#first range of the scan: start read-ahead of the columns from here
+                self.read_ahead('base', [INDIRECTION_COLUMN] + [4 + col for col in wanted], range_index)
+            pick = itemgetter(*slots) if len(slots) > 1 else lambda view: (view[slots[0]],)
+            indirections = pick(self.get_page('base', range_index, INDIRECTION_COLUMN).read_all())
+            base_values = [pick(self.get_page('base', range_index, 4 + col).read_all()) for col in wanted]
+            if not any(indirections):#no tail records so the base values are the latest (and only) versions
+                for column_values, picked in zip(values, base_values):
+                    column_values.extend(picked)
+                continue
+            rid_values = None
+            for position, (slot, indirection) in enumerate(zip(slots, indirections)):
+                if indirection != 0 and relative_version:
+                    if rid_values is None:
+                        rid_values = self.get_page('base', range_index, RID_COLUMN).read_all()
+                    record = self.get_record(rid_values[slot], relative_version, projection)
+                    if record is not None:
+                        for column_values, value in zip(values, record.columns):
+                            column_values.append(value)
+                elif indirection != 0 and indirection in self.page_directory:
+                    tail_rids.append(indirection)
+                else:
+                    for column_values, picked in zip(values, base_values):
+                        column_values.append(picked[position])
+        for range_index, slots in self.page_directory.slots_by_range(tail_rids, 'tail').items():
+            pick = itemgetter(*slots) if len(slots) > 1 else lambda view: (view[slots[0]],)
+            for column_values, col in zip(values, wanted):
+                column_values.extend(pick(self.get_page('tail', range_index, 4 + col).read_all()))
+        return [values[wanted.index(col)] for col in columns]
+
+    def tail_update(self, base_columns, tail_rid, version= None, projected = None):# sage tail update and partial merge because select versions requires a tail update? 
         #updates the tail pages used in get record
         #follows tail pages and indirection pointers to get a spesific version 
         #not full merge as it does not change tail records and does not modify pysical storage
         # THIS WILL NEED TO BE CHANGED FOR A FULL MERGE IMPLEMENTATION!!!!!
+        #base_columns holds the values of the columns in projected (every column by default), only their tail pages are read
         if tail_rid == 0 or tail_rid not in self.page_directory:#checks if the rid exists and is not 0 
             return base_columns
+        if projected is None:
+            projected = list(range(self.num_columns))
+
+        if version == 0 or version == None:
+            #every tail record is written with all columns as of its update, so the newest one alone is the latest version
+            tail_type, tail_range_index, tail_offset = self.page_directory[tail_rid]
+            return [self.get_page('tail', tail_range_index, 4 + col).read(tail_offset) for col in projected]
     
         # Build the tail chain to understand versions
         tail_chain = []
@@ -208,12 +596,8 @@ class Table:
             current_tail = self.get_page('tail', tail_range_index, INDIRECTION_COLUMN).read(tail_offset)
             
         # Determine how many tails to apply based on version
-        if version == 0 or version == None:
-            # Apply all tails
-            num_apply = len(tail_chain)
-        else:
-            num_skip = abs(version)
-            num_apply = max(0, len(tail_chain) - num_skip)
+        num_skip = abs(version)
+        num_apply = max(0, len(tail_chain) - num_skip)
         
         merged_columns = base_columns.copy()#Start with base columns
         
@@ -223,15 +607,10 @@ class Table:
             tail_type, tail_range_index, tail_offset = self.page_directory[item]#grab the range index and the offset 
             schema_encoding = self.get_page('tail', tail_range_index, SCHEMA_ENCODING_COLUMN).read(tail_offset)
             
-            # Batch read all columns at once to reduce page reads with small buffer
-            tail_columns = []
-            for col in range(self.num_columns):
-                tail_columns.append(self.get_page('tail', tail_range_index, 4 + col).read(tail_offset))
-            
-            #Apply updates from this tail record based on schema encoding
-            for col in range(self.num_columns):
+            #Apply updates from this tail record based on schema encoding, reading only the projected columns it changed
+            for position, col in enumerate(projected):
                 if schema_encoding & (1 << col):# check if it was updated
-                    merged_columns[col] = tail_columns[col]#set the update into merged columns 
+                    merged_columns[position] = self.get_page('tail', tail_range_index, 4 + col).read(tail_offset)#set the update into merged columns 
         
         return merged_columns #return all the updates 
     
@@ -242,11 +621,15 @@ class Table:
     def merge(self): #Sage fixed with bufferpool
 
         merge_rids = []# what rids need merging 
+        indirections = {}# range index -> decoded indirection page so each one is read in a single call
         for rid, location in list(self.page_directory.items()):#iterate throug the list form of the directory 
             page_type, range_index, offset = location#grab all the three normal criteria from the page directory 
             if page_type != 'base':#check if page type is a base page or tail page
                 continue
-            indirection = self.get_page('base', range_index, INDIRECTION_COLUMN).read(offset)#grab indirection from bufferpool
+            values = indirections.get(range_index)
+            if values is None:
+                values = indirections[range_index] = self.get_page('base', range_index, INDIRECTION_COLUMN).read_all().tolist()
+            indirection = values[offset // RECORD_SIZE]#grab indirection from the decoded page
             if indirection != 0 and indirection in self.page_directory:#if the indirection exissts and is in the directory
                 merge_rids.append(rid)#it needs merging 
 
@@ -260,29 +643,30 @@ class Table:
             for col in range(4, self.total_columns):#iterate through total columsn 
                 base_columns.append(self.get_page('base', base_range_index, col).read(base_offset))#append base columsn into base columsn from bufferpool
 
-            indirection = self.get_page('base', base_range_index, INDIRECTION_COLUMN).read(base_offset)#grab indirectionfrom base 
+            #indirection page is held (pinned) from reading the chain head until it is reset at the end
+            with self.operation(commit=False), self.pinned('base', base_range_index, INDIRECTION_COLUMN, dirty=True) as indirection_page:
+                indirection = indirection_page.read(base_offset)#grab indirectionfrom base 
 
-            merged_columns = self.tail_update(base_columns, indirection, version=0)#apply tail updates int obase columns
-            #writes merged values back into base pages
-            for idx, value in enumerate(merged_columns):#iterate through merged columsn 
-                page = self.get_page('base', base_range_index, idx + 4)#set page by getting it from bufferpool
-                page.update(base_offset, value)#run an update
-                self.put_page('base', base_range_index, idx + 4, page)#put the updated page back into buffer pool
+                merged_columns = self.tail_update(base_columns, indirection, version=0)#apply tail updates int obase columns
+                #writes merged values back into base pages
+                self.write_row('base', base_range_index, 4, base_offset, merged_columns)
 
-            current_tail = indirection#set current tail using indirection 
-            while current_tail != 0 and current_tail in self.page_directory:#while curent tail exists and is in the tail directory 
-                tail_type, tail_range, tail_offset = self.page_directory[current_tail]#grab the three criteria 
-                next_tail = self.get_page('tail', tail_range, INDIRECTION_COLUMN).read(tail_offset)#grab the new tail 
-                del self.page_directory[current_tail]#delete current tail 
-                current_tail = next_tail#set current tail to new tail to delete the whole chain 
+                current_tail = indirection#set current tail using indirection 
+                while current_tail != 0 and current_tail in self.page_directory:#while curent tail exists and is in the tail directory 
+                    tail_type, tail_range, tail_offset = self.page_directory[current_tail]#grab the three criteria 
+                    next_tail = self.get_page('tail', tail_range, INDIRECTION_COLUMN).read(tail_offset)#grab the new tail 
+                    self.set_location(current_tail, None)#delete current tail 
+                    current_tail = next_tail#set current tail to new tail to delete the whole chain 
 
-            #reset base indirection with no more tails 
-            page = self.get_page('base', base_range_index, INDIRECTION_COLUMN)
-            page.update(base_offset, 0)
-            self.put_page('base', base_range_index, INDIRECTION_COLUMN, page)
+                #reset base indirection with no more tails 
+                lsn = self.log(('row', self.name, 'base', base_range_index, INDIRECTION_COLUMN, base_offset, [0]))
+                self.write_slot(indirection_page, base_offset, 0, lsn)
 
-        # flush everything
-        self.bufferpool.flush_all()
+        if self.wal is not None:
+            self.commit()#the log has the merge, the pages can stay in the bufferpool
+        else:
+            # flush everything
+            self.bufferpool.flush_all()
     def close(self):
         # flush all dirty pages to disk on shutdown
         self.bufferpool.flush_all()
@@ -0,0 +1,208 @@
+import os
+import io
+import marshal
+import struct
+import threading
+import zlib
+
+"""
+Append-only write-ahead log. Every change to a page slot, the page directory or the set of tables is appended here
+before it is made, so Database.open can redo whatever had not reached the page files when the process stopped.
+Records are tuples (logged with marshal):
+  ('create', table, num_columns, key)                       a table was created
+  ('drop', table)                                           a table was dropped
+  ('range', table, page_type, r_idx)                        a new empty page range was started
+  ('row', table, page_type, r_idx, first_col, offset, values) values written at offset in columns first_col, first_col + 1, ...
+  ('dir', table, rid, location)                             page_directory[rid] = location, None removes the rid
+  ('fill', table, page_type, r_idx, col, offset, values)    values written into consecutive slots of column col from offset on (bulk loads)
+  ('place', table, first_rid, r_idx, offset, count)         count rids from first_rid on placed in consecutive base slots from offset on
+  ('index', table, column, kind)                            an index of kind ('btree', 'hash' or 'bitmap') was created on column
+  ('drop_index', table, column, kind)                       the index of kind on column was dropped, kind None drops all of them
+Pages remember the lsn of the last record applied to them in their header, so redo skips records a page already has
+Which columns are indexed is logged, index contents are not: they are rebuilt from the recovered pages instead
+A checkpoint (Database.checkpoint) truncates the log up to its checkpoint lsn, so the log only holds recent changes
+"""
+
+LOG_HEADER = struct.Struct('<8sq') # wal.log header: magic, lsn of the first record the file may hold
+LOG_FRAME = struct.Struct('<II') # in front of every record: payload length, crc32 of the payload
+LOG_MAGIC = b'LSTORWAL'
+SYNC_MODES = ('commit', 'interval', 'off')
+
+
+class WriteAheadLog():
+    # sync decides when commit() returns:
+    #   'commit': once the log is fsynced, commits that arrive while an fsync is running share the next one (group commit)
+    #   'interval': right away, a background thread fsyncs every sync_interval seconds (a crash loses at most that much)
+    #   'off': once the records are handed to the OS, never fsyncs (survives the process dying but not the machine)
+    def __init__(self, path, sync = 'commit', sync_interval = 0.01):
+        if sync not in SYNC_MODES:
+            raise ValueError("Unknown sync mode: " + str(sync))
+        self.path = path + "/wal.log"
+        self.sync = sync
+        self.sync_interval = sync_interval
+        self.lock = threading.Lock()
+        self.synced = threading.Condition(self.lock) # notified every time a write (and fsync) of the log finishes
+        self.buffer = [] # framed records appended since the last write to the file
+        self.syncing = False # a thread is writing the buffer out right now, the others wait for it
+        self.truncating = False # truncate is waiting for the file, no new write may start before it is done
+        self.pending = [] # (lsn, record) read back from the file on open, handed out once by replay
+        self.next_lsn = 1
+        self.chunks = [] # (first lsn, file offset) of every write to the file, truncate starts looking from these
+        if os.path.exists(self.path):
+            self.read_log()
+        else:
+            self.write_header()
+            self.size = LOG_HEADER.size
+            self.chunks.append((self.next_lsn, self.size))
+        self.durable_lsn = self.next_lsn - 1 # every record up to this lsn is in the file
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+        self.stopping = False
+        self.syncer = None
+        if sync == 'interval':
+            self.syncer = threading.Thread(target = self.sync_loop, daemon = True)
+            self.syncer.start()
+
+    def read_log(self):
+        # Loads the records of the last run, a torn record at the end (crash mid write) and anything after it is cut off
+        log_file = io.open(self.path, 'rb')
+        log = log_file.read()
+        log_file.close()
+        if len(log) < LOG_HEADER.size or LOG_HEADER.unpack_from(log, 0)[0] != LOG_MAGIC:
+            raise Exception("Write-ahead log at " + self.path + " is not readable")
+        self.next_lsn = LOG_HEADER.unpack_from(log, 0)[1]
+        position = LOG_HEADER.size
+        self.chunks.append((self.next_lsn, position))
+        while position + LOG_FRAME.size <= len(log):
+            length, crc = LOG_FRAME.unpack_from(log, position)
+            payload = log[position + LOG_FRAME.size:position + LOG_FRAME.size + length]
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                break
+            record = marshal.loads(payload)
+            self.pending.append((record[0], record[1:]))
+            self.next_lsn = record[0] + 1
+            position += LOG_FRAME.size + length
+        if position < len(log):
+            os.truncate(self.path, position)
+        self.size = position # bytes in the file, Database checkpoints once this grows too big
+
+    def write_header(self):
+        # Starts an empty log whose first record will get next_lsn, swapped in over the old file in one step
+        log_file = io.open(self.path + ".tmp", 'wb')
+        log_file.write(LOG_HEADER.pack(LOG_MAGIC, self.next_lsn))
+        log_file.flush()
+        os.fsync(log_file.fileno())
+        log_file.close()
+        os.replace(self.path + ".tmp", self.path)
+
+    def replay(self):
+        # Returns the (lsn, record) pairs found on open, oldest first, then forgets them
+        pending = self.pending
+        self.pending = []
+        return pending
+
+    def append(self, record):
+        # Adds a record to the log buffer and returns its lsn, nothing is written until commit or flush
+        with self.lock:
+            lsn = self.next_lsn
+            self.next_lsn += 1
+            payload = marshal.dumps((lsn,) + record)
+            self.buffer.append(LOG_FRAME.pack(len(payload), zlib.crc32(payload)) + payload)
+            return lsn
+
+    def commit(self):
+        # Makes everything appended so far durable according to the sync mode
+        if self.sync != 'interval':
+            self.flush()
+
+    def flush(self, lsn = None):
+        # Returns once every record up to lsn (everything appended so far by default) is in the file, and fsynced
+        # unless sync is 'off'. Whoever finds no write in progress writes the whole buffer, including records other
+        # threads appended meanwhile, so one fsync covers every commit waiting on it
+        while True:
+            with self.lock:
+                if lsn is None:
+                    lsn = self.next_lsn - 1
+                if self.durable_lsn >= lsn:
+                    return
+                if self.syncing or self.truncating:
+                    self.synced.wait()
+                    continue
+                self.syncing = True
+                data = b''.join(self.buffer)
+                self.buffer = []
+                upto = self.next_lsn - 1
+                self.chunks.append((self.durable_lsn + 1, self.size))
+            written = False
+            try:
+                os.write(self.fd, data)
+                if self.sync != 'off':
+                    os.fsync(self.fd)
+                written = True
+            finally:
+                with self.lock:
+                    self.syncing = False
+                    if written:
+                        self.durable_lsn = upto
+                        self.size += len(data)
+                    else:
+                        self.chunks.pop()
+                        self.buffer.insert(0, data) # keep the records in order for the next try
+                    self.synced.notify_all()
+
+    def sync_loop(self):
+        while not self.stopping:
+            with self.lock:
+                self.synced.wait(self.sync_interval)
+            self.flush()
+
+    def truncate(self, upto):
+        # Drops the records up to lsn upto once a checkpoint has every one of their changes in the page files and
+        # directory files, the rest of the file is copied into a new log that replaces the old one in one step
+        # lsns keep counting up from where they are so page headers stay comparable
+        with self.lock:
+            self.truncating = True
+            try:
+                while self.syncing:
+                    self.synced.wait()
+                self.replace_log(upto)
+            finally:
+                self.truncating = False
+                self.synced.notify_all()
+
+    def replace_log(self, upto):
+        # Called by truncate with the lock held and no write in progress
+        start = LOG_HEADER.size # records start after the header even if nothing was ever written
+        for first_lsn, offset in self.chunks:
+            if first_lsn > upto + 1:
+                break
+            start = offset # last write that began at or before the first record to keep
+        log_file = io.open(self.path, 'rb')
+        log_file.seek(start)
+        log = log_file.read()
+        log_file.close()
+        position = 0
+        while position + LOG_FRAME.size <= len(log):
+            length = LOG_FRAME.unpack_from(log, position)[0]
+            if marshal.loads(log[position + LOG_FRAME.size:position + LOG_FRAME.size + length])[0] > upto:
+                break
+            position += LOG_FRAME.size + length
+        kept = log[position:]
+        log_file = io.open(self.path + ".tmp", 'wb')
+        log_file.write(LOG_HEADER.pack(LOG_MAGIC, upto + 1))
+        log_file.write(kept)
+        log_file.flush()
+        os.fsync(log_file.fileno())
+        log_file.close()
+        os.close(self.fd)
+        os.replace(self.path + ".tmp", self.path)
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+        self.size = LOG_HEADER.size + len(kept)
+        self.chunks = [(upto + 1, LOG_HEADER.size)]
+
+    def close(self):
+        if self.syncer is not None:
+            self.stopping = True
+            self.syncer.join()
+            self.syncer = None
+        self.flush()
+        os.close(self.fd)
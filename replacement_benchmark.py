@@ -0,0 +1,75 @@
+from lstore.bufferpool import BufferPool
+from lstore.db import Database
+from lstore.query import Query
+from lstore.page import Page
+from time import process_time
+from random import Random
+import shutil
+import tempfile
+
+# Compares bufferpool replacement policies on a mixed workload: skewed point lookups on a hot set of pages
+# interrupted by long scans over cold pages (what one big Query.sum or an unindexed locate does to the pool)
+
+policies = ['lru', 'clock', '2q']
+capacity = 100
+hot_pages = 60
+cold_pages = 2000
+lookups = 20000
+scan_every = 1000
+
+path = tempfile.mkdtemp()
+pool = BufferPool(capacity=capacity, path=path, storage='segment')
+for i in range(hot_pages + cold_pages):
+    page = Page()
+    page.write(i)
+    pool.disk_manager.write_page('Bench', 'base', i, 0, page)
+pool.close()
+
+print("Pool level: %d frames, %d hot pages, scans of %d cold pages every %d lookups" % (capacity, hot_pages, cold_pages, scan_every))
+for policy in policies:
+    pool = BufferPool(capacity=capacity, path=path, storage='segment', replacement=policy)
+    rng = Random(3562901)
+    point_hits = 0
+    time_0 = process_time()
+    for i in range(lookups):
+        if i % scan_every == 0:
+            for page_number in range(hot_pages, hot_pages + cold_pages):
+                pool.get_page('Bench', 'base', page_number, 0)
+        page_number = min(int(rng.expovariate(1 / (hot_pages / 4))), hot_pages - 1) # skewed towards the first pages
+        hits = pool.hits
+        pool.get_page('Bench', 'base', page_number, 0)
+        point_hits += pool.hits - hits
+    time_1 = process_time()
+    print("%s:\tpoint lookup hit rate %.3f\toverall hit rate %.3f\ttook %.3f" % (
+        policy, point_hits / lookups, pool.hits / (pool.hits + pool.misses), time_1 - time_0))
+    pool.close()
+shutil.rmtree(path)
+
+# Same thing through queries: selects on a hot key range mixed with sums over the whole table
+records = 60000
+hot_keys = 1000
+selects = 5000
+sum_every = 500
+
+print("Query level: %d records, selects on %d hot keys, full table sum every %d selects" % (records, hot_keys, sum_every))
+for policy in policies:
+    path = tempfile.mkdtemp()
+    db = Database()
+    db.open(path, storage='segment', replacement=policy)
+    table = db.create_table('Grades', 5, 0)
+    query = Query(table)
+    for key in range(records):
+        query.insert(key, key % 20, 0, 0, 0)
+    pool = db.bufferpool
+    rng = Random(3562901)
+    hits, misses = pool.hits, pool.misses
+    time_0 = process_time()
+    for i in range(selects):
+        if i % sum_every == 0:
+            query.sum(0, records - 1, 1)
+        query.select(rng.randrange(hot_keys), 0, [1, 1, 1, 1, 1])
+    time_1 = process_time()
+    hits, misses = pool.hits - hits, pool.misses - misses
+    print("%s:\thit rate %.3f\ttook %.3f" % (policy, hits / (hits + misses), time_1 - time_0))
+    db.close()
+    shutil.rmtree(path)